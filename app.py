@@ -1,24 +1,38 @@
 '''
 Flask Application
 '''
-from flask import Flask, jsonify, request
+from flask import Flask, g, jsonify, request, send_file, stream_with_context
 from flask_cors import CORS
-from models import Experience, Education, Skill
+from changes import ChangeFeed, attach, event_stream, feed_of
+from logos import THUMBNAIL_SIZES, logo_store
+from metrics import instrument, registry
+from models import Experience, Education, Skill, SECTION_MODELS
+from ratelimit import admission, limit
+from store import DEFAULT_STORAGE, SQLITE_PATH, make_data
+from sqlite_store import SqliteEngine
+from serialization import ResumeJSONProvider
+from tenants import memory_usage, tenants
+from validation import VALIDATORS, PARTIAL_VALIDATORS
+from wal import WAL_DIR, WriteAheadLog
 from utils import (
-    get_experience_by_index, get_education_by_index,
+    EXPERIENCE_FIELDS, get_experience_by_index, get_education_by_index,
     get_skill_by_index, update_experience_by_index,
-    validate_request, delete_education_by_index,
-    update_education_by_index, update_skill_by_index
+    delete_education_by_index,
+    update_education_by_index, update_skill_by_index,
+    get_section_page, apply_bulk, export_ndjson, import_ndjson, patch_record, get_resume
 )
 app = Flask(__name__)
+app.json = ResumeJSONProvider(app)
 SERVER_ERROR = "Server Error"
 
  # CORS(app) Enables REST API receive http
  # requests without blocking/restricting
  # the request
 CORS(app)
+instrument(app)
+limit(app, admission)
 
-data = {
+SEED = {
     "experience": [
         Experience("Software Developer",
                    "A Cool Company",
@@ -42,6 +56,49 @@ data = {
     ]
 }
 
+if DEFAULT_STORAGE == "sqlite":
+    data = SqliteEngine(SQLITE_PATH).load(SEED)
+elif WAL_DIR:
+    data = WriteAheadLog(WAL_DIR).recover(make_data(SEED))
+else:
+    data = make_data(SEED)
+attach(data)
+
+
+@app.url_value_preprocessor
+def pull_user_id(_endpoint, values):
+    '''
+    Take the user id out of /users/<user_id>/... URLs, the handlers find it
+    in g.user_id
+    '''
+    if values and "user_id" in values:
+        g.user_id = values.pop("user_id")
+
+
+def resume_data():
+    '''
+    Return the sections the request works on: those of the user in the URL,
+    or the single resume of /resume/... URLs. A user without a resume sees
+    empty sections, and is only added by a write that adds a record
+    '''
+    user_id = g.get("user_id")
+    if user_id is None:
+        return data
+    return tenants.resume(user_id)
+
+
+@app.before_request
+def check_users_storage():
+    '''
+    Refuse /users/<user_id>/... requests when the resume is stored in SQLite
+    or a write-ahead log, as users are only ever kept in memory
+    '''
+    if g.get("user_id") is not None and (DEFAULT_STORAGE == "sqlite" or WAL_DIR):
+        return jsonify({"error": "Per-user resumes are not available with "
+                                 "RESUME_STORAGE=sqlite or RESUME_WAL_DIR"}), 501
+    return None
+
+
 @app.route('/')
 @app.route('/test')
 def hello_world():
@@ -51,7 +108,142 @@ def hello_world():
     return jsonify({"message": "Hello, World!"})
 
 
-@app.route('/resume/experience', methods=['GET', 'POST', 'PUT'])
+@app.route('/metrics')
+def metrics():
+    '''
+    Returns the request metrics in the Prometheus text format
+    '''
+    return app.response_class(registry.render(),
+                              content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.route('/cache/stats')
+def cache_stats():
+    '''
+    Returns the hit and miss counters of the JSON cache of each section
+    '''
+    return jsonify({name: section.cache.stats() for name, section in data.items()})
+
+
+@app.route('/logos/<logo_hash>')
+def logo(logo_hash):
+    '''
+    Serves a logo by the hash of its contents, or its thumbnail with
+    ?size=32, 64 or 128. The URL changes when the contents do, so clients
+    may cache the response forever
+    '''
+    size = request.args.get("size")
+    if size is not None and size not in map(str, THUMBNAIL_SIZES):
+        sizes = ", ".join(map(str, THUMBNAIL_SIZES))
+        return jsonify({"error": f"size must be one of {sizes}"}), 400
+    path = logo_store.path(logo_hash, None if size is None else int(size))
+    if path is None:
+        return jsonify({"Server Error": "Couldn't find needed logo"}), 404
+    response = send_file(path, mimetype=logo_store.mimetype(path),
+                         etag=f"{logo_hash}-{size or 'original'}",
+                         max_age=31536000, conditional=True)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+@app.route('/users/<user_id>/memory')
+def user_memory():
+    '''
+    Returns the number of records of a user and an estimate of the memory
+    they use
+    '''
+    return jsonify(memory_usage(resume_data()))
+
+
+@app.route('/resume')
+@app.route('/users/<user_id>/resume')
+def resume():
+    '''
+    Returns every section of the resume in one response, or only those
+    listed in ?sections=experience,skill
+    '''
+    return get_resume(resume_data(), request.args.get("sections"))
+
+
+@app.route('/resume/changes')
+@app.route('/users/<user_id>/resume/changes')
+def resume_changes():
+    '''
+    Streams the changes of the resume as Server-Sent Events to clients that
+    accept text/event-stream, starting after ?since= or Last-Event-ID.
+    Other clients get the changes after ?since= as JSON, or 410 Gone if some
+    of them are no longer kept and the sections must be fetched again.
+    Without since they only get the number of the last change
+    '''
+    # a user without a resume has no feed yet, reading doesn't create one
+    feed = feed_of(resume_data()) or ChangeFeed(0)
+    since = request.args.get("since", request.headers.get("Last-Event-ID"))
+    if since is not None and not since.isdigit():
+        return jsonify({"error": "since must be a change number"}), 400
+    if request.accept_mimetypes.best == "text/event-stream":
+        seq = feed.last if since is None else int(since)
+        response = app.response_class(
+            stream_with_context(event_stream(lambda: feed_of(resume_data()), seq,
+                                             waits=request.environ.get("resume.stream_waits"))),
+            mimetype="text/event-stream")
+        response.headers["Cache-Control"] = "no-cache"
+        return response
+    if since is None:
+        return jsonify({"last": feed.last, "events": []})
+    events = feed.since(int(since))
+    if events is None:
+        return jsonify({"error": "Changes are no longer available", "last": feed.last}), 410
+    return jsonify({"last": feed.last, "events": events})
+
+
+@app.route('/resume/export')
+@app.route('/users/<user_id>/resume/export')
+def export_resume():
+    '''
+    Streams every record of the resume as NDJSON, one record per line
+    '''
+    return app.response_class(stream_with_context(export_ndjson(resume_data())),
+                              mimetype="application/x-ndjson")
+
+
+@app.route('/resume/import', methods=['POST'])
+@app.route('/users/<user_id>/resume/import', methods=['POST'])
+def import_resume():
+    '''
+    Adds the records of an NDJSON upload, as produced by /resume/export,
+    reading it line by line
+    '''
+    return import_ndjson(resume_data(), request.stream)
+
+
+@app.route('/resume/<section>/bulk', methods=['POST'])
+@app.route('/users/<user_id>/resume/<section>/bulk', methods=['POST'])
+def bulk(section):
+    '''
+    Handles bulk requests for a section. The body is a list of operations
+    like {"op": "create", "record": {...}}, {"op": "update", "index": 0,
+    "record": {...}} or {"op": "delete", "index": 0}, which are validated
+    together and applied all at once
+    '''
+    if section not in SECTION_MODELS:
+        return jsonify({"Server Error": "Couldn't find needed section"}), 404
+    return apply_bulk(resume_data(), section, request.get_json())
+
+
+def handle_patch(section):
+    '''
+    Handle patch requests of any section. The body is a JSON Merge Patch of
+    the fields to change, only the fields that differ are written
+    '''
+    index = request.args.get("index")
+    if index is not None:
+        return patch_record(resume_data(), section, index, request.get_json())
+    return jsonify({"Server Error": "Couldn't process method"})
+
+
+@app.route('/resume/experience', methods=['GET', 'POST', 'PUT', 'PATCH'])
+@app.route('/users/<user_id>/resume/experience', methods=['GET', 'POST', 'PUT', 'PATCH'])
 def experience():
     '''
     Handles requests for experience. Determines what kind of request method 
@@ -68,6 +260,9 @@ def experience():
     if request.method == 'PUT':
         return handle_put_experience()
 
+    if request.method == 'PATCH':
+        return handle_patch("experience")
+
     return jsonify({"Server Error": "Couldn't process method"})
 
 def handle_get_experience():
@@ -78,8 +273,8 @@ def handle_get_experience():
 
     index = request.args.get("index")
     if index is not None:
-        return get_experience_by_index(data, index)
-    return jsonify(data["experience"])
+        return get_experience_by_index(resume_data(), index)
+    return get_section_page(resume_data(), "experience", request.args)
 
 def handle_post_experience():
     '''
@@ -90,10 +285,7 @@ def handle_post_experience():
 
     req = request.get_json()
 
-    required_fields = {"title":"string", "company":"string", "start_date":"string" \
-                           , "end_date":"string", "description":"string", "logo":"string"}
-
-    code, err_message = validate_request(req, required_fields)
+    code, err_message = VALIDATORS["experience"](req)
 
     if code != 0:
         return jsonify({"error": err_message}), code
@@ -106,30 +298,35 @@ def handle_post_experience():
                      req["logo"]
                      )
 
-    data["experience"].append(new)
+    new_id = resume_data()["experience"].append(new)
 
-    return jsonify({"id": data["experience"].index(new)})
+    return jsonify({"id": new_id})
 
 def handle_put_experience():
     '''
-    Will call and return get_experience_by_index function. From there, 
-    will check if there is a server error. If a server error exists, 
-    it will return that error, if not, will return the 
-    function update_experience_by_index
+    Will check that the experience exists. If it doesn't, it will return
+    a server error, if it does, will return the function
+    update_experience_by_index
     '''
 
     index = request.args.get("index")
     if index is not None:
         req = request.get_json()
-        existing_experience = get_experience_by_index(data, index)
-        if SERVER_ERROR in existing_experience.json:
-            # will return the server error returned by get_experience_by_index function
-            return existing_experience
-        return update_experience_by_index(data, index, req)
+        # look the record up directly, the GET response may be compressed
+        if resume_data()["experience"].key_of(index) is None:
+            return jsonify({SERVER_ERROR: "Couldn't find needed experience"})
+        if isinstance(req, dict):
+            # fields the model doesn't have are ignored
+            req = {field: req[field] for field in EXPERIENCE_FIELDS if field in req}
+        code, err_message = PARTIAL_VALIDATORS["experience"](req)
+        if code != 0:
+            return jsonify({"error": err_message}), code
+        return update_experience_by_index(resume_data(), index, req)
 
     return jsonify({"Server Error": "Couldn't process method"})
 
-@app.route('/resume/education', methods=['GET', 'POST', 'DELETE', 'PUT'])
+@app.route('/resume/education', methods=['GET', 'POST', 'DELETE', 'PUT', 'PATCH'])
+@app.route('/users/<user_id>/resume/education', methods=['GET', 'POST', 'DELETE', 'PUT', 'PATCH'])
 def education():
     '''
     Handles requests for education. If a GET request is called, will call 
@@ -151,6 +348,9 @@ def education():
     if request.method == 'PUT':
         return handle_put_education()
 
+    if request.method == 'PATCH':
+        return handle_patch("education")
+
     return jsonify({"Server Error": "Couldn't process method"})
 
 def handle_get_education():
@@ -159,8 +359,8 @@ def handle_get_education():
     '''
     index = request.args.get("index")
     if index is not None:
-        return get_education_by_index(data, index)
-    return jsonify(data["education"])
+        return get_education_by_index(resume_data(), index)
+    return get_section_page(resume_data(), "education", request.args)
 
 def handle_post_education():
     '''
@@ -168,10 +368,7 @@ def handle_post_education():
     '''
     req = request.get_json()
 
-    required_fields = {"school":"string", "start_date":"string", "end_date":"string" \
-                        , "grade":"string", "logo":"string"}
-
-    code, err_message = validate_request(req, required_fields)
+    code, err_message = VALIDATORS["education"](req)
 
     if code != 0:
         return jsonify({"error": err_message}), code
@@ -183,8 +380,8 @@ def handle_post_education():
         req["grade"],
         req["logo"]
     )
-    data["education"].append(new)
-    return jsonify({"id": data["education"].index(new)})
+    new_id = resume_data()["education"].append(new)
+    return jsonify({"id": new_id})
 
 def handle_delete_education():
     '''
@@ -192,14 +389,17 @@ def handle_delete_education():
     '''
     index = request.args.get("index")
     if index is not None:
-        return delete_education_by_index(data, index)
-    return jsonify(data["education"])
+        return delete_education_by_index(resume_data(), index)
+    return jsonify(list(resume_data()["education"]))
 
 def handle_put_education():
     '''
     Handle education put requests
     '''
     req = request.get_json()
+    code, err_message = VALIDATORS["education"](req)
+    if code != 0:
+        return jsonify({"error": err_message}), code
     updated = Education(req["course"],
         req["school"],
         req["start_date"],
@@ -209,11 +409,12 @@ def handle_put_education():
     )
     index = request.args.get("index")
     if index is not None:
-        return update_education_by_index(data, index, updated)
-    return jsonify(data["education"])
+        return update_education_by_index(resume_data(), index, updated)
+    return jsonify(list(resume_data()["education"]))
 
 
-@app.route('/resume/skill', methods=['GET', 'POST', 'PUT'])
+@app.route('/resume/skill', methods=['GET', 'POST', 'PUT', 'PATCH'])
+@app.route('/users/<user_id>/resume/skill', methods=['GET', 'POST', 'PUT', 'PATCH'])
 def skill():
     '''
     Handles requests for skill. If a GET request is called, will call and return 
@@ -232,6 +433,9 @@ def skill():
     if request.method == 'PUT':
         return handle_put_skill()
 
+    if request.method == 'PATCH':
+        return handle_patch("skill")
+
     return jsonify({"Server Error": "Couldn't process method"})
 
 
@@ -241,8 +445,8 @@ def handle_get_skill():
     '''
     index = request.args.get("index")
     if index is not None:
-        return get_skill_by_index(data, index)
-    return jsonify(data["skill"])
+        return get_skill_by_index(resume_data(), index)
+    return get_section_page(resume_data(), "skill", request.args)
 
 def handle_post_skill():
     '''
@@ -250,28 +454,29 @@ def handle_post_skill():
     '''
     req = request.get_json()
 
-    required_fields = {"name":"string", "proficiency":"string", "logo":"string"}
-
-    code, err_message = validate_request(req, required_fields)
+    code, err_message = VALIDATORS["skill"](req)
 
     if code != 0:
         return jsonify({"error": err_message}), code
 
     new = Skill(req["name"], req["proficiency"], req["logo"])
-    data["skill"].append(new)
+    new_id = resume_data()["skill"].append(new)
 
-    return jsonify({"id": data["skill"].index(new)})
+    return jsonify({"id": new_id})
 
 def handle_put_skill():
     '''
     Handle skill put requests
     '''
     req = request.get_json()
+    code, err_message = VALIDATORS["skill"](req)
+    if code != 0:
+        return jsonify({"error": err_message}), code
     updated = Skill(req["name"],
         req["proficiency"],
         req["logo"]
     )
     index = request.args.get("index")
     if index is not None:
-        return update_skill_by_index(data, index, updated)
-    return jsonify(data["skill"])
+        return update_skill_by_index(resume_data(), index, updated)
+    return jsonify(list(resume_data()["skill"]))
@@ -0,0 +1,208 @@
+'''
+ASGI entry point, serving the same routes as the Flask app in app.py.
+Run it with any ASGI server, for example: uvicorn asgi:application
+
+Receiving the request body and sending the response happen on the event
+loop, so a slow client only holds a coroutine. The Flask handlers themselves
+run in a thread pool, on the same data as the WSGI app, and read the body as
+it arrives. An event stream waits for changes on the event loop, so it only
+holds a thread while it builds a chunk. A response stops streaming when its
+client disconnects
+'''
+
+import asyncio
+import contextvars
+import io
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from app import app
+
+# Threads running the Flask handlers
+WORKERS = int(os.environ.get("RESUME_ASGI_WORKERS", "32"))
+# Chunks of a request body received ahead of the handler reading them
+BODY_CHUNKS = 4
+
+executor = ThreadPoolExecutor(WORKERS, thread_name_prefix="asgi")
+
+
+class RequestBody(io.RawIOBase):
+    '''
+    wsgi.input of a request whose body is still arriving. The event loop
+    puts the chunks it receives in a queue, the handler thread takes them
+    from it as it reads, waiting when it has read everything received
+    '''
+
+    def __init__(self, loop):
+        super().__init__()
+        self.loop = loop
+        # chunks of the body, then None at its end
+        self.chunks = asyncio.Queue(BODY_CHUNKS)
+        self._rest = memoryview(b"")
+        self._ended = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._rest and not self._ended:
+            chunk = asyncio.run_coroutine_threadsafe(self.chunks.get(), self.loop).result()
+            if chunk is None:
+                self._ended = True
+            else:
+                self._rest = memoryview(chunk)
+        size = min(len(buffer), len(self._rest))
+        buffer[:size] = self._rest[:size]
+        self._rest = self._rest[size:]
+        return size
+
+
+def _environ(scope, body):
+    '''
+    Build the WSGI environ of an ASGI http scope
+    '''
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode().decode("latin-1"),
+        "PATH_INFO": scope["path"].encode().decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": client[0],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": body,
+        # the body ends when the client says so, with or without a length
+        "wsgi.input_terminated": True,
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+        # where an event stream puts what it waits for, see changes.event_stream
+        "resume.stream_waits": [],
+    }
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        if name not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            name = f"HTTP_{name}"
+        value = value.decode("latin-1")
+        environ[name] = f"{environ[name]},{value}" if name in environ else value
+    return environ
+
+
+def _call_app(environ):
+    '''
+    Call the Flask app. Returns the status, the headers and an iterator over
+    the body
+    '''
+    started = []
+
+    def start_response(status, headers, exc_info=None):
+        if exc_info is not None and started:
+            raise exc_info[1].with_traceback(exc_info[2])
+        started[:] = [status, headers]
+
+    body = app(environ, start_response)
+    return started[0], started[1], body
+
+
+async def _receive(receive, body, disconnected):
+    '''
+    Pass the chunks of the request body to the handler, then wait for the
+    client to disconnect
+    '''
+    more_body = True
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            disconnected.set()
+            if more_body:
+                await body.chunks.put(None)
+            return
+        if more_body:
+            if message.get("body"):
+                await body.chunks.put(message["body"])
+            more_body = message.get("more_body", False)
+            if not more_body:
+                await body.chunks.put(None)
+
+
+async def _stream_wait(wait, disconnected):
+    '''
+    Wait for what an event stream waits for, a change of its feed or some
+    time while it has none, or until the client disconnects
+    '''
+    feed, seq, timeout = wait
+    waiting = asyncio.ensure_future(
+        asyncio.sleep(timeout) if feed is None else feed.changed(seq, timeout))
+    gone = asyncio.ensure_future(disconnected.wait())
+    await asyncio.wait([waiting, gone], return_when=asyncio.FIRST_COMPLETED)
+    waiting.cancel()
+    gone.cancel()
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def application(scope, receive, send):
+    '''
+    The ASGI application
+    '''
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    loop = asyncio.get_running_loop()
+    request_body = RequestBody(loop)
+    disconnected = asyncio.Event()
+    receiving = asyncio.create_task(_receive(receive, request_body, disconnected))
+    try:
+        await _respond(loop, _environ(scope, request_body), send, disconnected)
+    finally:
+        receiving.cancel()
+
+
+async def _respond(loop, environ, send, disconnected):
+    '''
+    Call the Flask app and send its response, until the client disconnects
+    '''
+    # every step of the request runs in the same context, as Flask keeps its
+    # request context in context variables while a response streams
+    context = contextvars.copy_context()
+    status, headers, body = await loop.run_in_executor(executor, context.run, _call_app, environ)
+    await send({
+        "type": "http.response.start",
+        "status": int(status.split(" ", 1)[0]),
+        "headers": [(name.lower().encode("latin-1"), value.encode("latin-1"))
+                    for name, value in headers],
+    })
+    # the body may be a stream like the NDJSON export or the change feed,
+    # pull it a chunk at a time. The change feed hands its waits over to the
+    # loop instead of holding a thread through them
+    waits = environ["resume.stream_waits"]
+    chunks = iter(body)
+    try:
+        while not disconnected.is_set():
+            chunk = await loop.run_in_executor(executor, context.run, next, chunks, None)
+            if chunk is None:
+                await send({"type": "http.response.body", "body": b"", "more_body": False})
+                break
+            if waits:
+                await _stream_wait(waits.pop(), disconnected)
+            if chunk and not disconnected.is_set():
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+    finally:
+        if hasattr(body, "close"):
+            await loop.run_in_executor(executor, context.run, body.close)
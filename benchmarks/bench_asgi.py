@@ -0,0 +1,108 @@
+'''
+Load benchmark of the two ways to serve the app: the WSGI app on werkzeug's
+threaded server and the ASGI application in asgi.py on uvicorn. Prints
+requests per second and p99 latency at high concurrency for each.
+
+uvicorn is not a dependency of the app, install it to benchmark the ASGI
+mode: pip install uvicorn
+
+Run from the repository root: python benchmarks/bench_asgi.py
+'''
+
+import http.client
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+from werkzeug.serving import WSGIRequestHandler, make_server
+from app import app
+from asgi import application
+
+try:
+    import uvicorn
+except ImportError:
+    uvicorn = None
+
+CONCURRENCY = 64
+REQUESTS = 50
+WSGI_PORT = 5071
+ASGI_PORT = 5072
+
+
+class QuietHandler(WSGIRequestHandler):
+    '''
+    Request handler that doesn't log every request
+    '''
+
+    def log_request(self, code="-", size="-"):
+        pass
+
+
+def load(port, path="/resume/experience"):
+    '''
+    Send CONCURRENCY * REQUESTS GETs from CONCURRENCY threads. Returns the
+    requests per second and the p99 latency in milliseconds
+    '''
+    latencies = []
+
+    def client():
+        for _ in range(REQUESTS):
+            start = time.perf_counter()
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+            connection.request("GET", path)
+            connection.getresponse().read()
+            connection.close()
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(CONCURRENCY) as pool:
+        for _ in range(CONCURRENCY):
+            pool.submit(client)
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return len(latencies) / elapsed, latencies[int(len(latencies) * 0.99) - 1] * 1000
+
+
+def wait_for(port):
+    '''
+    Wait until a server accepts connections on port
+    '''
+    for _ in range(100):
+        try:
+            http.client.HTTPConnection("127.0.0.1", port, timeout=1).connect()
+            return
+        except OSError:
+            time.sleep(0.05)
+
+
+def main():
+    '''
+    Benchmark the WSGI server, then the ASGI one if uvicorn is installed
+    '''
+    server = make_server("127.0.0.1", WSGI_PORT, app, threaded=True,
+                         request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    wait_for(WSGI_PORT)
+    requests_per_second, p99 = load(WSGI_PORT)
+    print(f"WSGI (werkzeug threaded): {requests_per_second:8.0f} req/s  p99 {p99:7.1f} ms")
+    server.shutdown()
+
+    if uvicorn is None:
+        print("ASGI: skipped, install uvicorn to benchmark it")
+        return
+    asgi_server = uvicorn.Server(uvicorn.Config(application, host="127.0.0.1", port=ASGI_PORT,
+                                                log_level="warning", backlog=4096))
+    threading.Thread(target=asgi_server.run, daemon=True).start()
+    wait_for(ASGI_PORT)
+    requests_per_second, p99 = load(ASGI_PORT)
+    print(f"ASGI (uvicorn):           {requests_per_second:8.0f} req/s  p99 {p99:7.1f} ms")
+    asgi_server.should_exit = True
+
+
+if __name__ == "__main__":
+    main()
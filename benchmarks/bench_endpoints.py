@@ -0,0 +1,260 @@
+'''
+Benchmark of every /resume endpoint: GET-all, GET-by-index, POST, PUT and
+DELETE, with each section seeded with 10, 1k, 100k and 1M records. Every
+endpoint is measured through the Flask test client and through a real local
+server, for throughput and latency percentiles.
+
+GET-all is measured cold, encoding the section every time, and warm, served
+from the JSON cache. Every PUT and POST sends a different record, as writing
+a record identical to the stored one is not a write.
+
+Results are written as JSON and compared with a baseline from an earlier run:
+an endpoint whose p50 latency or throughput got worse by more than the
+tolerance is reported, and the exit status is 1.
+
+Run from the repository root:
+  python benchmarks/bench_endpoints.py --output results.json
+  python benchmarks/bench_endpoints.py --sizes 10,1000 --baseline results.json
+'''
+
+import argparse
+import http.client
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+from werkzeug.serving import WSGIRequestHandler, make_server
+from app import app, data
+from models import Education, Experience, Skill
+from store import make_section
+
+SIZES = (10, 1000, 100000, 1000000)
+# Each endpoint runs for this many seconds, at least MIN_OPS and at most MAX_OPS times
+BUDGET = 1.0
+MIN_OPS = 3
+MAX_OPS = 2000
+PORT = 5073
+SEED = 1234
+
+BODIES = {
+    "experience": {"title": "Benchmark Engineer", "company": "Bench Co",
+                   "start_date": "May 2021", "end_date": "Present",
+                   "description": "Measuring endpoints", "logo": "example-logo.png"},
+    "education": {"course": "Benchmarking", "school": "Bench University",
+                  "start_date": "September 2018", "end_date": "July 2021",
+                  "grade": "90%", "logo": "example-logo.png"},
+    "skill": {"name": "Benchmarking", "proficiency": "2-4 Years", "logo": "example-logo.png"},
+}
+# Field of BODIES that gets the number of the operation
+VARIED = {"experience": "description", "education": "course", "skill": "name"}
+
+
+def make_records(section, size):
+    '''
+    Return size records of a section, with a realistic mix of repeated and
+    unique values
+    '''
+    if section == "experience":
+        return [Experience(f"Engineer {number}", f"Company {number % 500}",
+                           f"October {2000 + number % 20}", "Present",
+                           f"Worked on project {number}", "example-logo.png")
+                for number in range(size)]
+    if section == "education":
+        return [Education(f"Course {number}", f"School {number % 200}",
+                          f"September {2000 + number % 20}", f"July {2003 + number % 20}",
+                          f"{number % 100}%", "example-logo.png")
+                for number in range(size)]
+    return [Skill(f"Skill {number}", f"{number % 10}-{number % 10 + 2} Years",
+                  "example-logo.png")
+            for number in range(size)]
+
+
+class QuietHandler(WSGIRequestHandler):
+    '''
+    Request handler with keep-alive connections that doesn't log requests
+    '''
+    protocol_version = "HTTP/1.1"
+
+    def log_request(self, code="-", size="-"):
+        pass
+
+
+def test_client_transport():
+    '''
+    Return a function that sends a request through the Flask test client and
+    returns the status code
+    '''
+    client = app.test_client()
+
+    def send(method, path, body=None):
+        return client.open(path, method=method, json=body).status_code
+
+    return send
+
+
+def server_transport(port):
+    '''
+    Return a function that sends a request to a local server over one
+    keep-alive connection and returns the status code
+    '''
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=120)
+
+    def send(method, path, body=None):
+        headers = {}
+        if body is not None:
+            body = json.dumps(body)
+            headers["Content-Type"] = "application/json"
+        connection.request(method, path, body=body, headers=headers)
+        response = connection.getresponse()
+        response.read()
+        return response.status
+
+    return send
+
+
+def endpoints(section):
+    '''
+    Return the (name, method, path function, body function, setup) of the
+    endpoints of a section. The path function gets the current number of
+    records, the body function the number of the operation. setup, if any,
+    runs untimed before each operation
+    '''
+    path = f"/resume/{section}"
+
+    def by_index(count):
+        return f"{path}?index={random.randrange(count)}"
+
+    def body(number):
+        field = VARIED[section]
+        return {**BODIES[section], field: f"{BODIES[section][field]} {number}"}
+
+    def no_body(_number):
+        return None
+
+    result = [
+        ("GET-all-cold", "GET", lambda count: path, no_body, data[section].cache.invalidate),
+        # the last cold GET left the section in the cache
+        ("GET-all-warm", "GET", lambda count: path, no_body, None),
+        ("GET-by-index", "GET", by_index, no_body, None),
+        ("PUT", "PUT", by_index, body, None),
+        ("POST", "POST", lambda count: path, body, None),
+    ]
+    if section == "education":
+        result.append(("DELETE", "DELETE", by_index, no_body, None))
+    return result
+
+
+def measure(transport, section, endpoint):
+    '''
+    Call an endpoint, a (method, path function, body function, setup) of
+    endpoints(), repeatedly. Returns its throughput and latency percentiles
+    in milliseconds, setup excluded
+    '''
+    method, path, body, setup = endpoint
+    latencies = []
+    elapsed = 0.0
+    while len(latencies) < MAX_OPS and (len(latencies) < MIN_OPS or elapsed < BUDGET):
+        if len(data[section]) < 2:
+            break
+        request_path = path(len(data[section]))
+        request_body = body(len(latencies))
+        if setup is not None:
+            setup()
+        request_start = time.perf_counter()
+        status = transport(method, request_path, request_body)
+        latencies.append(time.perf_counter() - request_start)
+        elapsed += latencies[-1]
+        if status != 200:
+            raise RuntimeError(f"{method} {request_path} answered {status}")
+    latencies.sort()
+
+    def percentile(fraction):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))] * 1000
+
+    return {"ops": len(latencies), "ops_per_second": len(latencies) / elapsed,
+            "p50_ms": percentile(0.5), "p90_ms": percentile(0.9), "p99_ms": percentile(0.99)}
+
+
+def run(sizes):
+    '''
+    Run every endpoint at every size through both transports and return the
+    results keyed like "server/1000/skill/GET-all"
+    '''
+    server = make_server("127.0.0.1", PORT, app, threaded=True, request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    transports = {"test_client": test_client_transport(), "server": server_transport(PORT)}
+    results = {}
+    try:
+        for size in sizes:
+            for section in BODIES:
+                for transport_name, transport in transports.items():
+                    # reseed so every transport starts from the same data
+                    data[section] = make_section(make_records(section, size), name=section)
+                    random.seed(SEED)
+                    for name, *endpoint in endpoints(section):
+                        key = f"{transport_name}/{size}/{section}/{name}"
+                        results[key] = measure(transport, section, endpoint)
+                        print(f"{key:45} {results[key]['ops_per_second']:10.0f} ops/s"
+                              f"  p50 {results[key]['p50_ms']:8.3f} ms"
+                              f"  p99 {results[key]['p99_ms']:8.3f} ms", flush=True)
+                data[section] = make_section(name=section)
+    finally:
+        server.shutdown()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    '''
+    Return a message for every result that got worse than its baseline by
+    more than tolerance (0.25 is 25%)
+    '''
+    regressions = []
+    for key, result in results.items():
+        before = baseline.get(key)
+        if before is None:
+            continue
+        if result["p50_ms"] > before["p50_ms"] * (1 + tolerance):
+            regressions.append(f"{key}: p50 {before['p50_ms']:.3f} -> {result['p50_ms']:.3f} ms")
+        if result["ops_per_second"] < before["ops_per_second"] * (1 - tolerance):
+            regressions.append(f"{key}: {before['ops_per_second']:.0f} -> "
+                               f"{result['ops_per_second']:.0f} ops/s")
+    return regressions
+
+
+def main():
+    '''
+    Parse the arguments, run the benchmark, write and compare the results
+    '''
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", maxsplit=1)[0])
+    parser.add_argument("--sizes", default=",".join(map(str, SIZES)),
+                        help="comma separated numbers of records per section")
+    parser.add_argument("--output", default="bench_results.json",
+                        help="file the results are written to")
+    parser.add_argument("--baseline", help="results of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed slowdown before a result counts as a regression")
+    args = parser.parse_args()
+
+    results = run([int(size) for size in args.sizes.split(",")])
+    with open(args.output, "w", encoding="utf-8") as output:
+        json.dump({"python": sys.version.split()[0], "results": results}, output, indent=2)
+    print(f"results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as baseline:
+            regressions = compare(results, json.load(baseline)["results"], args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print("no regressions against the baseline")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+'''
+Benchmark of the memory used per Experience record, comparing a plain
+dataclass (how the models used to be defined) with the slotted, interned
+models in models.py
+
+Run from the repository root: python benchmarks/bench_memory.py
+'''
+
+import gc
+import json
+import os
+import sys
+import tracemalloc
+from dataclasses import fields, make_dataclass
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+from models import Experience
+
+COUNT = 100000
+COMPANIES = 50
+
+# Experience as it was defined before, with a __dict__ per instance
+PlainExperience = make_dataclass("PlainExperience",
+                                 [(field.name, field.type) for field in fields(Experience)])
+
+
+def payload():
+    '''
+    Return the records as they arrive over HTTP: decoded from JSON, so equal
+    values are still separate string objects
+    '''
+    return json.loads(json.dumps([{
+        "title": f"Engineer {number}",
+        "company": f"Company {number % COMPANIES}",
+        "start_date": f"October {2000 + number % 20}",
+        "end_date": "Present",
+        "description": f"Worked on project {number}",
+        "logo": "example-logo.png",
+    } for number in range(COUNT)]))
+
+
+def bytes_per_record(model):
+    '''
+    Build COUNT records of model and return the memory they hold per record,
+    strings included
+    '''
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    bodies = payload()
+    records = [model(**body) for body in bodies]
+    del bodies
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    assert len(records) == COUNT
+    return (after - before) / COUNT
+
+
+def main():
+    '''
+    Print the bytes per record of both definitions
+    '''
+    print(f"{COUNT} records")
+    print(f"plain dataclass:           {bytes_per_record(PlainExperience):.0f} bytes per record")
+    print(f"slotted, interned records: {bytes_per_record(Experience):.0f} bytes per record")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+'''
+Benchmark of encoding records as JSON: time to encode 10k records of each
+model with the generic dataclasses.asdict fallback, and with the app's JSON
+provider on the json module and on orjson when it is installed
+
+Run from the repository root: python benchmarks/bench_serialization.py
+'''
+
+import dataclasses
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+import serialization
+from app import app
+from models import Education, Experience, Skill
+
+RECORDS = 10000
+REPEAT = 5
+
+SAMPLES = {
+    "experience": [Experience(f"Engineer {number}", f"Company {number % 500}",
+                              "October 2020", "Present", f"Worked on project {number}",
+                              "example-logo.png") for number in range(RECORDS)],
+    "education": [Education(f"Course {number}", f"School {number % 200}", "September 2018",
+                            "July 2021", f"{number % 100}%", "example-logo.png")
+                  for number in range(RECORDS)],
+    "skill": [Skill(f"Skill {number}", "1-2 Years", "example-logo.png")
+              for number in range(RECORDS)],
+}
+
+
+def asdict_default(o):
+    '''
+    The generic fallback: a deep copy of each record through dataclasses.asdict
+    '''
+    return dataclasses.asdict(o)
+
+
+def best_ms(encode, records):
+    '''
+    Return the best time of REPEAT runs of encode(records) in milliseconds
+    '''
+    return min(timeit.repeat(lambda: encode(records), number=1, repeat=REPEAT)) * 1000
+
+
+def main():
+    '''
+    Print the encode time of RECORDS records of each model for each encoder
+    '''
+    orjson = serialization.orjson
+    # (name, orjson module the provider sees, encode function)
+    encoders = [
+        ("asdict + json", None,
+         lambda records: json.dumps(records, default=asdict_default, sort_keys=True)),
+        ("provider, json", None, app.json.dumps),
+        ("provider, orjson", orjson, app.json.dumps),
+    ]
+    print(f"ms to encode {RECORDS} records")
+    with app.app_context():
+        for section, records in SAMPLES.items():
+            for name, backend, encode in encoders:
+                if name == "provider, orjson" and orjson is None:
+                    print(f"{section:12} {name:18} skipped, install orjson to benchmark it")
+                    continue
+                serialization.orjson = backend
+                print(f"{section:12} {name:18} {best_ms(encode, records):8.1f}")
+    serialization.orjson = orjson
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+'''
+Benchmark of the per-request cost of validating a POST body, comparing
+utils.validate_request with the validators compiled in validation.py, with
+and without the stage timing the app wraps them in
+
+Run from the repository root: python benchmarks/bench_validation.py
+'''
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+from models import Experience
+from utils import validate_request
+from validation import VALIDATORS, compile_validator
+
+NUMBER = 200000
+
+EXPERIENCE = {
+    "title": "Data Engineer", "company": "A Data Company",
+    "start_date": "May 2021", "end_date": "Present",
+    "description": "Building pipelines", "logo": "example-logo.png",
+}
+
+
+def per_call(statement):
+    '''
+    Return the best time of one call in microseconds
+    '''
+    best = min(timeit.repeat(statement, number=NUMBER, repeat=5))
+    return best / NUMBER * 1e6
+
+
+def main():
+    '''
+    Print the time per validation with both approaches
+    '''
+    def old():
+        # the handlers used to rebuild this dict on every request
+        required_fields = {"title": "string", "company": "string", "start_date": "string",
+                           "end_date": "string", "description": "string", "logo": "string"}
+        return validate_request(EXPERIENCE, required_fields)
+
+    validate = VALIDATORS["experience"]
+    untimed = compile_validator(Experience)
+    print(f"validate_request + dict per call: {per_call(old):.3f} us")
+    print(f"compiled validator, timed:        {per_call(lambda: validate(EXPERIENCE)):.3f} us")
+    print(f"compiled validator, not timed:    {per_call(lambda: untimed(EXPERIENCE)):.3f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+'''
+Benchmark of the write-ahead log: write throughput of concurrent writers at
+each fsync policy, and the time to recover the sections from the log alone
+and from a snapshot
+
+Run from the repository root: python benchmarks/bench_wal.py
+'''
+
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+from models import Skill
+from store import make_data
+from wal import FSYNC_POLICIES, WriteAheadLog
+
+THREADS = 8
+WRITES = 500
+
+
+def write_throughput(directory, policy):
+    '''
+    Return the writes per second of THREADS threads appending WRITES skills each
+    '''
+    wal = WriteAheadLog(directory, policy)
+    section = wal.recover(make_data({"skill": []}))["skill"]
+
+    def writer(number):
+        for write in range(WRITES):
+            section.append(Skill(f"Skill {number}-{write}", "1-2 Years", "example-logo.png"))
+
+    threads = [threading.Thread(target=writer, args=(number,)) for number in range(THREADS)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    wal.close()
+    return THREADS * WRITES / elapsed
+
+
+def recovery_time(directory):
+    '''
+    Return the seconds it takes to recover the sections from a directory
+    '''
+    start = time.perf_counter()
+    wal = WriteAheadLog(directory, "off")
+    wal.recover(make_data({"skill": []}))
+    elapsed = time.perf_counter() - start
+    wal.close()
+    return elapsed
+
+
+def main():
+    '''
+    Print the throughput at each policy, then the recovery times
+    '''
+    with tempfile.TemporaryDirectory() as root:
+        for policy in FSYNC_POLICIES:
+            directory = os.path.join(root, policy)
+            print(f"{policy:>8}: {write_throughput(directory, policy):10.0f} writes/s")
+
+        directory = os.path.join(root, "off")
+        print(f"recovery from the log ({THREADS * WRITES} writes): "
+              f"{recovery_time(directory) * 1000:.1f} ms")
+        wal = WriteAheadLog(directory, "off")
+        wal.recover(make_data({"skill": []}))
+        wal.snapshot()
+        wal.close()
+        print(f"recovery from a snapshot:           {recovery_time(directory) * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
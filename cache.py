@@ -0,0 +1,119 @@
+'''
+Cache of encoded JSON for a resume section. Reads are served from here and
+every write to the section drops the entries it affects
+'''
+
+import hashlib
+import threading
+from compress import COMPRESSORS
+
+
+def _entry(body):
+    '''
+    Pair encoded bytes with an ETag made from their hash
+    '''
+    return body, hashlib.md5(body, usedforsecurity=False).hexdigest()
+
+
+class JSONCache:
+    '''
+    Holds the encoded bytes of a whole section and of single records, keyed
+    by the record key, together with an ETag computed from the bytes.
+    Counts hits and misses so the ratio can be checked.
+
+    Encoding happens without any lock. Every invalidation bumps a generation
+    number, and an entry is only stored if no invalidation happened while it
+    was being encoded, so a reader racing a writer never caches stale bytes.
+
+    Compressed copies of the entries are kept by ETag and dropped together
+    with their entry, so each write is compressed at most once per encoding
+    '''
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._collection = None
+        self._records = {}
+        self._compressed = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def collection(self, build):
+        '''
+        Return the (bytes, etag) of the section, calling build() to encode it on a miss
+        '''
+        entry = self._collection
+        if entry is None:
+            self.misses += 1
+            generation = self._generation
+            entry = _entry(build())
+            with self._lock:
+                if generation == self._generation:
+                    self._collection = entry
+        else:
+            self.hits += 1
+        return entry
+
+    def record(self, key, build):
+        '''
+        Return the (bytes, etag) of the record with the given key, calling build()
+        to encode it on a miss
+        '''
+        entry = self._records.get(key)
+        if entry is None:
+            self.misses += 1
+            generation = self._generation
+            entry = _entry(build())
+            with self._lock:
+                if generation == self._generation:
+                    self._records[key] = entry
+        else:
+            self.hits += 1
+        return entry
+
+    def compressed(self, entry, encoding):
+        '''
+        Return the body of a (bytes, etag) entry compressed with the given
+        encoding, compressing it on a miss
+        '''
+        body, etag = entry
+        compressed = self._compressed.get((etag, encoding))
+        if compressed is None:
+            generation = self._generation
+            compressed = COMPRESSORS[encoding](body)
+            with self._lock:
+                if generation == self._generation:
+                    self._compressed[(etag, encoding)] = compressed
+        return compressed
+
+    def _drop_compressed(self, entry):
+        if entry is not None:
+            for encoding in COMPRESSORS:
+                self._compressed.pop((entry[1], encoding), None)
+
+    def invalidate(self, key=None):
+        '''
+        Drop the encoded section and, if a key is given, that record
+        '''
+        with self._lock:
+            self._generation += 1
+            self._drop_compressed(self._collection)
+            self._collection = None
+            if key is not None:
+                self._drop_compressed(self._records.pop(key, None))
+
+    def clear(self):
+        '''
+        Drop every encoded entry
+        '''
+        with self._lock:
+            self._generation += 1
+            self._collection = None
+            self._records.clear()
+            self._compressed.clear()
+
+    def stats(self):
+        '''
+        Return the hit and miss counters
+        '''
+        return {"hits": self.hits, "misses": self.misses}
@@ -0,0 +1,162 @@
+'''
+Feed of the changes made to a resume, so clients can apply them instead of
+fetching whole sections again. Every create, update and delete gets the next
+sequence number and is kept in a ring of the last RESUME_CHANGES_SIZE
+changes. Each resume, the single one and each user's, has its own feed,
+which its sections publish to while they hold their lock, so the numbers
+follow the order the writes were applied in.
+
+/resume/changes serves it as Server-Sent Events, or as JSON for clients
+catching up with ?since=<seq>. Under ASGI an event stream waits for changes
+on the event loop, not in a thread
+'''
+
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+from itertools import islice
+from flask import current_app
+
+FEED_SIZE = int(os.environ.get("RESUME_CHANGES_SIZE", "1024"))
+# Seconds between keep-alive comments on an idle event stream
+KEEPALIVE = 15
+# Seconds between looks for the feed of a user who has no resume yet
+NO_FEED_POLL = 1
+
+
+class ChangeFeed:
+    '''
+    Ring of the last changes, numbered from 1. Readers can wait for changes
+    newer than the ones they have
+    '''
+
+    def __init__(self, size=FEED_SIZE):
+        self.last = 0
+        self._events = deque(maxlen=size)
+        self._changed = threading.Condition()
+        # futures of the coroutines waiting in changed, with their loops
+        self._waiters = {}
+
+    def publish(self, section, kind, record_id, record=None):
+        '''
+        Add a change and wake up the waiting readers. Returns its number
+        '''
+        with self._changed:
+            self.last += 1
+            self._events.append({"seq": self.last, "section": section, "type": kind,
+                                 "id": record_id, "record": record})
+            self._changed.notify_all()
+            for future, loop in self._waiters.items():
+                loop.call_soon_threadsafe(_wake, future)
+            self._waiters.clear()
+            return self.last
+
+    def since(self, seq):
+        '''
+        Return the changes numbered after seq, or None if some of them have
+        already left the ring or seq is from before a restart
+        '''
+        with self._changed:
+            return self._since(seq)
+
+    def _since(self, seq):
+        first = self._events[0]["seq"] if self._events else self.last + 1
+        if not first - 1 <= seq <= self.last:
+            return None
+        return list(islice(self._events, max(0, seq - first + 1), None))
+
+    def wait(self, seq, timeout=None):
+        '''
+        Like since, but wait up to timeout seconds for a change after seq
+        '''
+        with self._changed:
+            self._changed.wait_for(lambda: self.last > seq, timeout)
+            return self._since(seq)
+
+    async def changed(self, seq, timeout=None):
+        '''
+        Like wait for a coroutine: return once there is a change after seq or
+        timeout seconds have passed, without holding a thread
+        '''
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._changed:
+            if self.last > seq:
+                return
+            self._waiters[future] = loop
+        try:
+            await asyncio.wait([future], timeout=timeout)
+        finally:
+            with self._changed:
+                self._waiters.pop(future, None)
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+
+def attach(data):
+    '''
+    Give the sections of a resume a new feed, and return it. Each section
+    gets the feed and its own name to publish its changes under
+    '''
+    feed = ChangeFeed()
+    for name, section in data.items():
+        section.feed = (feed, name)
+    return feed
+
+
+def feed_of(data):
+    '''
+    Return the feed of a resume, or None if it has none, like the sections
+    of a user who doesn't exist yet
+    '''
+    section_feed = next(iter(data.values())).feed
+    return None if section_feed is None else section_feed[0]
+
+
+def _sse(event_id, kind, body):
+    return f"id: {event_id}\nevent: {kind}\ndata: {body}\n\n".encode()
+
+
+def event_stream(find_feed, seq, keepalive=KEEPALIVE, waits=None):
+    '''
+    Yield the changes after seq as Server-Sent Events, then every new change
+    as it happens. If changes were missed, a "reset" event tells the client
+    to fetch the sections again before the stream goes on from the newest.
+    find_feed returns the feed, or None while the resume has none yet.
+
+    Given a waits list, the stream doesn't block: it appends the feed, seq
+    and timeout it would wait with and yields an empty chunk, for the server
+    to wait with ChangeFeed.changed before asking for the next one
+    '''
+    while True:
+        feed = find_feed()
+        if feed is None:
+            # the user has no resume yet, look again in a moment
+            if waits is None:
+                time.sleep(NO_FEED_POLL)
+            else:
+                waits.append((None, seq, NO_FEED_POLL))
+                yield b""
+            yield b": keep-alive\n\n"
+            continue
+        if waits is None:
+            events = feed.wait(seq, keepalive)
+        else:
+            waits.append((feed, seq, keepalive))
+            yield b""
+            events = feed.since(seq)
+        if events is None:
+            seq = feed.last
+            yield _sse(seq, "reset", current_app.json.dumps({"last": seq}))
+            continue
+        if not events:
+            yield b": keep-alive\n\n"
+            continue
+        yield b"".join(_sse(event["seq"], event["type"], current_app.json.dumps(event))
+                       for event in events)
+        seq = events[-1]["seq"]
@@ -0,0 +1,41 @@
+'''
+Compression of cached JSON responses, negotiated with Accept-Encoding.
+Brotli is used when the brotli package is installed, gzip otherwise
+'''
+
+import gzip
+import os
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Responses smaller than this are sent uncompressed, compressing them costs
+# more than it saves
+MIN_SIZE = int(os.environ.get("RESUME_COMPRESS_MIN_SIZE", "1024"))
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def _gzip(body):
+    # mtime=0 so the same body always compresses to the same bytes
+    return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def _brotli(body):
+    return brotli.compress(body, quality=BROTLI_QUALITY)
+
+
+# Supported encodings, most preferred first
+COMPRESSORS = {"gzip": _gzip} if brotli is None else {"br": _brotli, "gzip": _gzip}
+
+
+def choose_encoding(accept_encodings, size):
+    '''
+    Return the encoding to compress a body of the given size with, from the
+    parsed Accept-Encoding header of the request, or None to send it as is
+    '''
+    if size < MIN_SIZE:
+        return None
+    return accept_encodings.best_match(list(COMPRESSORS))
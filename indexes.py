@@ -0,0 +1,226 @@
+'''
+Secondary indexes of the in-memory sections, used by the search parameters
+of the collection GETs. Exact fields get a hash index (value -> keys) and
+text fields an inverted index (token -> keys), so a query costs about the
+size of its result instead of the size of the section
+'''
+
+import re
+from bisect import bisect_left, bisect_right, insort
+
+# Fields that can be filtered on with field=value, per section
+EXACT_FIELDS = {
+    "experience": ("title", "company"),
+    "education": ("course", "school"),
+    "skill": ("name", "proficiency"),
+}
+
+# Fields searched by q=, per section
+TEXT_FIELDS = {
+    "experience": ("title", "description"),
+    "education": ("course", "school"),
+    "skill": ("name",),
+}
+
+# Date fields kept in a sorted index, for from=/to= and chronological sort=
+DATE_FIELDS = {
+    "experience": ("start_date", "end_date"),
+    "education": ("start_date", "end_date"),
+    "skill": (),
+}
+
+TOKEN = re.compile(r"\w+")
+MONTHS = {name: number for number, name in enumerate(
+    ("january", "february", "march", "april", "may", "june", "july",
+     "august", "september", "october", "november", "december"))}
+MONTHS.update({name[:3]: number for name, number in list(MONTHS.items())})
+ONGOING = ("present", "current", "now")
+# Ordinal of an ongoing date like "Present", later than any real date
+PRESENT = 10 ** 6
+
+
+def tokenize(text):
+    '''
+    Split text into the lower case words it is indexed under
+    '''
+    return set(TOKEN.findall(text.lower()))
+
+
+def parse_date(text):
+    '''
+    Turn a date like "October 2022", "Oct 2022", "2022-10", "2022" or
+    "Present" into a month ordinal (year * 12 + month) that sorts
+    chronologically. Returns None if the date can't be parsed
+    '''
+    words = TOKEN.findall(text.lower()) if isinstance(text, str) else []
+    if len(words) == 1 and words[0] in ONGOING:
+        return PRESENT
+    if len(words) == 1 and words[0].isdigit():
+        return int(words[0]) * 12
+    if len(words) == 2 and words[1].isdigit() and words[0] in MONTHS:
+        return int(words[1]) * 12 + MONTHS[words[0]]
+    if len(words) == 2 and words[0].isdigit() and words[1].isdigit() \
+            and 1 <= int(words[1]) <= 12:
+        return int(words[0]) * 12 + int(words[1]) - 1
+    return None
+
+
+class SectionIndex:
+    '''
+    Indexes of one section, keyed by record key. Writers update them while
+    holding the section lock; readers only use single set operations, which
+    are atomic, so they never need the lock
+    '''
+
+    def __init__(self, exact_fields=(), text_fields=(), date_fields=()):
+        self.exact_fields = exact_fields
+        self.text_fields = text_fields
+        self.date_fields = date_fields
+        self._exact = {field: {} for field in exact_fields}
+        self._tokens = {}
+        # per date field, the sorted (ordinal, key) pairs of the parsable
+        # dates and the ordinal of every record, parsed once when it's written
+        self._dates = {field: [] for field in date_fields}
+        self._ordinals = {field: {} for field in date_fields}
+
+    def _record_tokens(self, record):
+        tokens = set()
+        for field in self.text_fields:
+            tokens |= tokenize(getattr(record, field))
+        return tokens
+
+    def add(self, key, record):
+        '''
+        Index a record under its key
+        '''
+        for field, postings in self._exact.items():
+            postings.setdefault(getattr(record, field), set()).add(key)
+        for token in self._record_tokens(record):
+            self._tokens.setdefault(token, set()).add(key)
+        for field in self.date_fields:
+            self._add_date(field, key, record)
+
+    @staticmethod
+    def _discard(postings, value, key):
+        '''
+        Drop key from the postings of value, and the value once it has none
+        '''
+        keys = postings.get(value)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del postings[value]
+
+    def _add_date(self, field, key, record):
+        ordinal = self._ordinals[field][key] = parse_date(getattr(record, field))
+        if ordinal is not None:
+            insort(self._dates[field], (ordinal, key))
+
+    def _remove_date(self, field, key):
+        ordinal = self._ordinals[field].pop(key, None)
+        if ordinal is not None:
+            dates = self._dates[field]
+            position = bisect_left(dates, (ordinal, key))
+            if position < len(dates) and dates[position] == (ordinal, key):
+                del dates[position]
+
+    def remove(self, key, record):
+        '''
+        Drop a record from the indexes
+        '''
+        for field, postings in self._exact.items():
+            self._discard(postings, getattr(record, field), key)
+        for token in self._record_tokens(record):
+            self._discard(self._tokens, token, key)
+        for field in self.date_fields:
+            self._remove_date(field, key)
+
+    def update(self, key, old, record):
+        '''
+        Move a record from its old to its new values, touching only the
+        indexes of the fields that changed. Everything that can fail is
+        worked out before any index is changed
+        '''
+        exact = [(postings, getattr(old, field), getattr(record, field))
+                 for field, postings in self._exact.items()
+                 if getattr(old, field) != getattr(record, field)]
+        for _, _, after in exact:
+            # fails on a value that can't be a dict key
+            hash(after)
+        tokens = None
+        if any(getattr(old, field) != getattr(record, field) for field in self.text_fields):
+            tokens = self._record_tokens(old), self._record_tokens(record)
+        for postings, before, after in exact:
+            self._discard(postings, before, key)
+            postings.setdefault(after, set()).add(key)
+        if tokens is not None:
+            before, after = tokens
+            for token in before - after:
+                self._discard(self._tokens, token, key)
+            for token in after - before:
+                self._tokens.setdefault(token, set()).add(key)
+        for field in self.date_fields:
+            if getattr(old, field) != getattr(record, field):
+                self._remove_date(field, key)
+                self._add_date(field, key, record)
+
+    def search(self, filters, query=None):
+        '''
+        Return the set of keys of the records matching every field=value filter
+        and containing every word of query, or None if there are no conditions
+        '''
+        postings = [self._exact[field].get(value, set()) for field, value in filters.items()]
+        if query:
+            postings += [self._tokens.get(token, set()) for token in tokenize(query)]
+        if not postings:
+            return None
+        postings.sort(key=len)
+        return postings[0].intersection(*postings[1:])
+
+    def date_range(self, field, low=None, high=None):
+        '''
+        Return the keys of the records whose date field is between the low and
+        high ordinals (both included), in chronological order. Costs
+        O(log n + k) thanks to the sorted index
+        '''
+        dates = self._dates[field]
+        start = 0 if low is None else bisect_left(dates, (low,))
+        end = len(dates) if high is None else bisect_right(dates, (high, float("inf")))
+        return [key for _, key in dates[start:end]]
+
+    def date_order(self, field, keys=None, reverse=False):
+        '''
+        Sort keys (every key if None) chronologically by a date field,
+        unparsable dates last in key order
+        '''
+        ordinals = self._ordinals[field]
+        if keys is None:
+            # walk the sorted index instead of sorting
+            ordered = [key for _, key in self._dates[field][:]]
+            undated = sorted(key for key, ordinal in list(ordinals.items()) if ordinal is None)
+        else:
+            ordered = sorted((key for key in keys if ordinals.get(key) is not None),
+                             key=ordinals.get)
+            undated = sorted(key for key in keys if ordinals.get(key) is None)
+        if reverse:
+            ordered.reverse()
+        return ordered + undated
+
+    def query(self, filters, query=None, date_range=None, sort=None):
+        '''
+        Return the keys matching the filters and query, in key order, or None
+        for every key when there are no conditions. date_range is
+        (field, low, high) and keeps the records with a date in that range,
+        sort is (field, reverse) and orders them by a date field
+        '''
+        keys = self.search(filters, query)
+        if date_range is not None:
+            in_range = self.date_range(*date_range)
+            in_range = in_range if keys is None else [key for key in in_range if key in keys]
+            if sort is not None and sort[0] == date_range[0]:
+                # already in the right order
+                return in_range[::-1] if sort[1] else in_range
+            keys = in_range
+        if sort is not None:
+            return self.date_order(sort[0], keys, sort[1])
+        return None if keys is None else sorted(keys)
@@ -0,0 +1,163 @@
+'''
+Logo files served under /logos/<hash>, where the hash is the hash of the file
+contents. The URL of a logo changes whenever its contents change, so the
+responses can be cached forever. Resized thumbnails are generated once and
+cached on disk when Pillow is installed
+'''
+
+import hashlib
+import mimetypes
+import os
+import threading
+from werkzeug.security import safe_join
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Directory the logo filenames of the records are relative to. Only files
+# directly in it with a LOGO_EXTENSIONS suffix are ever served
+LOGO_DIR = os.environ.get("RESUME_LOGO_DIR", os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "logos"))
+THUMBNAIL_DIR = os.environ.get("RESUME_THUMBNAIL_DIR", os.path.join(LOGO_DIR, ".thumbnails"))
+THUMBNAIL_SIZES = (32, 64, 128)
+LOGO_EXTENSIONS = (".png", ".jpg", ".jpeg", ".gif", ".webp", ".svg")
+# Set RESUME_LOGO_URLS=1 to replace the logo filename of every serialized
+# record with its /logos/<hash> URL
+REWRITE_LOGOS = os.environ.get("RESUME_LOGO_URLS") == "1"
+
+
+def is_logo_filename(filename):
+    '''
+    Tell if a logo value is the name of an image file, without any directory
+    '''
+    return (isinstance(filename, str) and filename.lower().endswith(LOGO_EXTENSIONS)
+            and not filename.startswith(".") and "/" not in filename and "\\" not in filename)
+
+
+class LogoStore:
+    '''
+    Maps logo filenames to content hashes and back. A file is only hashed
+    again when its size or modification time changes, and the directory is
+    only scanned again when its own modification time changes
+    '''
+
+    def __init__(self, logo_dir=LOGO_DIR, thumbnail_dir=THUMBNAIL_DIR):
+        self.logo_dir = logo_dir
+        self.thumbnail_dir = thumbnail_dir
+        self._by_name = {}
+        self._by_hash = {}
+        # modification time of the logo directory when it was last scanned
+        self._scanned = None
+        self._lock = threading.Lock()
+
+    def logo_hash(self, filename):
+        '''
+        Return the content hash of a logo file, or None if there is no such
+        image file directly in the logo directory
+        '''
+        path = safe_join(self.logo_dir, filename) if is_logo_filename(filename) else None
+        if path is None or not os.path.isfile(path):
+            return None
+        stat = os.stat(path)
+        known = self._by_name.get(filename)
+        if known is not None and known[0] == (stat.st_mtime_ns, stat.st_size):
+            return known[1]
+        with open(path, "rb") as logo:
+            digest = hashlib.sha256(logo.read()).hexdigest()[:32]
+        with self._lock:
+            if known is not None:
+                # the old URL must not serve the new contents
+                self._by_hash.pop(known[1], None)
+            self._by_name[filename] = ((stat.st_mtime_ns, stat.st_size), digest)
+            self._by_hash[digest] = path
+        self._make_thumbnails(digest, path)
+        return digest
+
+    def url(self, filename):
+        '''
+        Return the /logos/<hash> URL of a logo, or the filename unchanged if
+        the file doesn't exist
+        '''
+        digest = self.logo_hash(filename)
+        return filename if digest is None else f"/logos/{digest}"
+
+    def path(self, digest, size=None):
+        '''
+        Return the path of the logo (or of its thumbnail of the given size)
+        with the given hash, or None if it is unknown or the file no longer
+        has these contents
+        '''
+        if digest not in self._by_hash:
+            # the URL may come from before a restart
+            self._scan()
+        path = self._by_hash.get(digest)
+        # records are served from the JSON cache, so the file may have
+        # changed since its URL was made
+        if path is None or self.logo_hash(os.path.basename(path)) != digest:
+            return None
+        if size is None:
+            return path
+        thumbnail = self._thumbnail_path(digest, size)
+        return thumbnail if os.path.isfile(thumbnail) else path
+
+    def _scan(self):
+        '''
+        Hash every logo of the directory, unless nothing was added, removed or
+        renamed in it since the last scan
+        '''
+        try:
+            modified = os.stat(self.logo_dir).st_mtime_ns
+        except OSError:
+            return
+        with self._lock:
+            if modified == self._scanned:
+                return
+            self._scanned = modified
+        for filename in os.listdir(self.logo_dir):
+            self.logo_hash(filename)
+
+    def mimetype(self, path):
+        '''
+        Return the mimetype of a logo file
+        '''
+        return mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+    def _thumbnail_path(self, digest, size):
+        return os.path.join(self.thumbnail_dir, f"{digest}-{size}.png")
+
+    def _make_thumbnails(self, digest, path):
+        '''
+        Write the thumbnails of a logo that aren't on disk yet. Without Pillow,
+        or for files Pillow can't read, the original logo is served instead
+        '''
+        if Image is None or path.lower().endswith(".svg"):
+            return
+        missing = [size for size in THUMBNAIL_SIZES
+                   if not os.path.isfile(self._thumbnail_path(digest, size))]
+        if not missing:
+            return
+        os.makedirs(self.thumbnail_dir, exist_ok=True)
+        try:
+            with Image.open(path) as image:
+                for size in missing:
+                    thumbnail = image.copy()
+                    thumbnail.thumbnail((size, size))
+                    # write to a temporary file first so readers never see half a file
+                    temporary = f"{self._thumbnail_path(digest, size)}.{threading.get_ident()}"
+                    thumbnail.save(temporary, "PNG")
+                    os.replace(temporary, self._thumbnail_path(digest, size))
+        except OSError:
+            return
+
+
+logo_store = LogoStore()
+
+
+def public_logo(filename):
+    '''
+    Return the logo value to send to clients: the /logos/<hash> URL when
+    RESUME_LOGO_URLS=1 is set and the file exists, the filename otherwise
+    '''
+    return logo_store.url(filename) if REWRITE_LOGOS else filename
@@ -0,0 +1,331 @@
+'''
+Request metrics in the Prometheus text format, served on /metrics:
+request counts, error counts, latency per route, time spent in each stage
+of a request, and request and response sizes.
+
+Set RESUME_PROFILE=1 to allow profiling single requests: a request with the
+header X-Profile: 1 is sampled while it runs and its hot stacks are written
+to a file in RESUME_PROFILE_DIR, whose path is sent back in X-Profile-Dump
+'''
+
+import functools
+import os
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from bisect import bisect_left, bisect_right
+from collections import Counter, deque
+from dataclasses import dataclass
+from operator import itemgetter
+from flask import Request, g, request
+
+DURATION_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                    0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+# Stage durations waiting to be added to their histogram, see Registry.pending
+MAX_PENDING = 16384
+
+PROFILING = os.environ.get("RESUME_PROFILE") == "1"
+PROFILE_DIR = os.environ.get("RESUME_PROFILE_DIR", tempfile.gettempdir())
+PROFILE_INTERVAL = int(os.environ.get("RESUME_PROFILE_INTERVAL_US", "1000")) / 1e6
+PROFILE_TOP = 20
+
+HELP = {
+    "resume_requests_total": ("counter", "Requests handled"),
+    "resume_request_errors_total": ("counter", "Requests answered with a 4xx or 5xx status"),
+    "resume_request_duration_seconds": ("histogram", "Time to handle a request"),
+    "resume_stage_duration_seconds": (
+        "histogram", "Time spent in each stage of a request, lookup includes serialize"),
+    "resume_request_size_bytes": ("histogram", "Size of request bodies"),
+    "resume_response_size_bytes": ("histogram", "Size of response bodies"),
+}
+
+
+@dataclass
+class Histogram:
+    '''
+    Counts observations in fixed buckets, like a Prometheus histogram
+    '''
+    buckets: tuple
+    counts: list = None
+    sum: float = 0.0
+    count: int = 0
+
+    def __post_init__(self):
+        if self.counts is None:
+            self.counts = [0] * (len(self.buckets) + 1)
+
+    def observe(self, value):
+        '''
+        Add an observation. Must hold the registry lock
+        '''
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def observe_many(self, values):
+        '''
+        Add a batch of observations, sorting them once instead of placing
+        each one in its bucket. Must hold the registry lock
+        '''
+        values = sorted(values)
+        below = 0
+        for position, bound in enumerate(self.buckets):
+            upto = bisect_right(values, bound, below)
+            self.counts[position] += upto - below
+            below = upto
+        self.counts[-1] += len(values) - below
+        self.sum += sum(values)
+        self.count += len(values)
+
+
+class Registry:
+    '''
+    Holds the counters and histograms, keyed by metric name and labels
+    '''
+
+    def __init__(self):
+        self.counters = Counter()
+        self.histograms = {}
+        # key -> (deque of observations, buckets)
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, **labels):
+        '''
+        Add one to a counter
+        '''
+        key = (name, tuple(labels.items()))
+        with self._lock:
+            self.counters[key] += 1
+
+    def observe(self, name, value, buckets=DURATION_BUCKETS, **labels):
+        '''
+        Add an observation to a histogram
+        '''
+        key = (name, tuple(labels.items()))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def pending(self, name, buckets=DURATION_BUCKETS, **labels):
+        '''
+        Return a deque the observations of a histogram can be appended to
+        without the lock or any lookup. They are added to the histogram when
+        the metrics are rendered, or by fold once there are many
+        '''
+        key = (name, tuple(labels.items()))
+        with self._lock:
+            if key not in self._pending:
+                self._pending[key] = (deque(), buckets)
+            return self._pending[key][0]
+
+    def fold(self):
+        '''
+        Add the pending observations to their histograms
+        '''
+        with self._lock:
+            self._fold()
+
+    def _fold(self):
+        for key, (values, buckets) in self._pending.items():
+            if not values:
+                continue
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            # appends go on while this runs, only the lock holder pops
+            histogram.observe_many([values.popleft() for _ in range(len(values))])
+
+    def render(self):
+        '''
+        Return every metric in the Prometheus text format
+        '''
+        with self._lock:
+            self._fold()
+            counters = sorted(self.counters.items())
+            histograms = sorted(((key, Histogram(histogram.buckets, list(histogram.counts),
+                                                 histogram.sum, histogram.count))
+                                 for key, histogram in self.histograms.items()),
+                                key=itemgetter(0))
+        lines = []
+        seen = set()
+
+        def header(name):
+            if name not in seen:
+                seen.add(name)
+                kind, description = HELP[name]
+                lines.extend((f"# HELP {name} {description}", f"# TYPE {name} {kind}"))
+
+        for (name, labels), value in counters:
+            header(name)
+            lines.append(f"{name}{_labels(labels)} {value}")
+        for (name, labels), histogram in histograms:
+            header(name)
+            lines.extend(_histogram_lines(name, labels, histogram))
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels):
+    '''
+    Format labels like {route="/test",method="GET"}
+    '''
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+               for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+
+def _histogram_lines(name, labels, histogram):
+    '''
+    Return the bucket, sum and count lines of a histogram
+    '''
+    cumulative = 0
+    lines = []
+    for bound, count in zip((*histogram.buckets, "+Inf"), histogram.counts):
+        cumulative += count
+        lines.append(f"{name}_bucket{_labels(labels + (('le', bound),))} {cumulative}")
+    lines.append(f"{name}_sum{_labels(labels)} {histogram.sum}")
+    lines.append(f"{name}_count{_labels(labels)} {histogram.count}")
+    return lines
+
+
+registry = Registry()
+
+
+def timed(stage):
+    '''
+    Decorate a function to record its duration as a stage of the request.
+    The durations are only appended to a deque, so timing costs little more
+    than reading the clock twice
+    '''
+    durations = registry.pending("resume_stage_duration_seconds", stage=stage)
+    clock = time.perf_counter
+
+    def decorate(function):
+        @functools.wraps(function)
+        def timed_function(*args, **kwargs):
+            start = clock()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                durations.append(clock() - start)
+                if len(durations) > MAX_PENDING:
+                    registry.fold()
+        return timed_function
+    return decorate
+
+
+class TimedRequest(Request):
+    '''
+    Request class that records the time spent parsing the JSON body
+    '''
+
+    @timed("parse")
+    def get_json(self, *args, **kwargs):
+        return super().get_json(*args, **kwargs)
+
+
+class SamplingProfiler:
+    '''
+    Samples the stack of one thread at a fixed interval from a background
+    thread, and counts how often each stack was seen
+    '''
+
+    def __init__(self, thread_id, interval=PROFILE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)  # pylint: disable=protected-access
+            if frame is not None:
+                stack = traceback.extract_stack(frame)
+                self.samples[tuple(f"{entry.filename}:{entry.lineno} {entry.name}"
+                                   for entry in stack)] += 1
+
+    def start(self):
+        '''
+        Start sampling
+        '''
+        self._thread.start()
+        return self
+
+    def stop(self):
+        '''
+        Stop sampling and wait for the sampler thread
+        '''
+        self._stop.set()
+        self._thread.join()
+
+    def hot_stacks(self, limit=PROFILE_TOP):
+        '''
+        Return the limit most sampled stacks as text, innermost call first
+        '''
+        if not self.samples:
+            return "No samples, the request was shorter than the sampling interval\n"
+        blocks = []
+        for stack, count in self.samples.most_common(limit):
+            blocks.append(f"{count} samples\n" + "\n".join(f"  {line}" for line in reversed(stack)))
+        return "\n\n".join(blocks) + "\n"
+
+
+def _route():
+    return request.url_rule.rule if request.url_rule is not None else "unmatched"
+
+
+def instrument(app):
+    '''
+    Record the metrics of every request of a Flask app
+    '''
+    app.request_class = TimedRequest
+    wsgi_app = app.wsgi_app
+
+    def timed_wsgi_app(environ, start_response):
+        environ["resume.start"] = time.perf_counter()
+        return wsgi_app(environ, start_response)
+
+    app.wsgi_app = timed_wsgi_app
+
+    @app.before_request
+    def start_request():
+        start = request.environ.get("resume.start", time.perf_counter())
+        registry.observe("resume_stage_duration_seconds", time.perf_counter() - start,
+                         stage="routing")
+        if request.content_length:
+            registry.observe("resume_request_size_bytes", request.content_length, SIZE_BUCKETS,
+                             route=_route())
+        if PROFILING and request.headers.get("X-Profile") == "1":
+            g.profiler = SamplingProfiler(threading.get_ident()).start()
+
+    @app.after_request
+    def finish_request(response):
+        route = _route()
+        start = request.environ.get("resume.start")
+        if start is not None:
+            registry.observe("resume_request_duration_seconds", time.perf_counter() - start,
+                             route=route, method=request.method)
+        registry.inc("resume_requests_total", route=route, method=request.method,
+                     status=response.status_code)
+        if response.status_code >= 400:
+            registry.inc("resume_request_errors_total", route=route, method=request.method,
+                         status=response.status_code)
+        if response.content_length is not None:
+            registry.observe("resume_response_size_bytes", response.content_length,
+                             SIZE_BUCKETS, route=route)
+        profiler = g.pop("profiler", None)
+        if profiler is not None:
+            profiler.stop()
+            fd, path = tempfile.mkstemp(prefix="profile-", suffix=".txt", dir=PROFILE_DIR)
+            with os.fdopen(fd, "w", encoding="utf-8") as dump:
+                dump.write(f"{request.method} {request.full_path}\n\n{profiler.hot_stacks()}")
+            response.headers["X-Profile-Dump"] = path
+        return response
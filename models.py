@@ -4,10 +4,28 @@
 Models for the Resume API. Each class is related to
 '''
 
+import os
+import sys
 from dataclasses import dataclass
 
+# Records use __slots__ instead of a per instance __dict__. Set
+# RESUME_FROZEN_MODELS=1 to also make them immutable, the app only ever
+# replaces records with dataclasses.replace so it works either way
+FROZEN = os.environ.get("RESUME_FROZEN_MODELS") == "1"
 
-@dataclass
+
+def _intern(record, names):
+    '''
+    Intern the given string fields of a record, so records that repeat a
+    value (a logo, "Present", a company) share one string object
+    '''
+    for name in names:
+        value = getattr(record, name)
+        if isinstance(value, str):
+            object.__setattr__(record, name, sys.intern(value))
+
+
+@dataclass(slots=True, frozen=FROZEN)
 class Experience:
     '''
     Experience Class
@@ -19,8 +37,11 @@ class Experience:
     description: str
     logo: str
 
+    def __post_init__(self):
+        _intern(self, ("company", "start_date", "end_date", "logo"))
 
-@dataclass
+
+@dataclass(slots=True, frozen=FROZEN)
 class Education:
     '''
     Education Class
@@ -32,8 +53,11 @@ class Education:
     grade: str
     logo: str
 
+    def __post_init__(self):
+        _intern(self, ("course", "school", "start_date", "end_date", "grade", "logo"))
+
 
-@dataclass
+@dataclass(slots=True, frozen=FROZEN)
 class Skill:
     '''
     Skill Class
@@ -41,3 +65,14 @@ class Skill:
     name: str
     proficiency: str
     logo: str
+
+    def __post_init__(self):
+        _intern(self, ("name", "proficiency", "logo"))
+
+
+# Model used by each resume section
+SECTION_MODELS = {
+    "experience": Experience,
+    "education": Education,
+    "skill": Skill,
+}
@@ -0,0 +1,257 @@
+'''
+Admission control: per client token buckets and a bound on the requests
+handled at once. Both are off unless configured.
+
+- RESUME_RATE_READ and RESUME_RATE_WRITE set the budget of reads (GET, HEAD,
+  OPTIONS) and of writes as "rate/burst", in requests per second, for
+  example "50/100". Each client IP has its own buckets, and so does each
+  user of /users/<user_id>/... routes. A request over budget gets 429
+- RESUME_MAX_IN_FLIGHT bounds the requests handled at once. A request waits
+  up to RESUME_QUEUE_TIMEOUT_MS milliseconds for a slot, then gets 503
+- RESUME_RATE_SHARED=1 keeps the buckets in a file every worker process of
+  the machine maps in memory, so the budgets hold across all of them
+  instead of per process
+
+Both answers carry a Retry-After header with the seconds to wait
+'''
+
+import fcntl
+import hashlib
+import math
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from flask import g, jsonify, request
+
+READ_METHODS = ("GET", "HEAD", "OPTIONS")
+# Clients whose buckets are kept in memory, the least recently seen go first
+MAX_CLIENTS = 100000
+# Slots of the shared table, a client whose slot is taken by another
+# one starts again with a full bucket
+SHARED_SLOTS = 65536
+SHARED_NAME = "resume-ratelimit"
+# Endpoints that are never limited
+EXEMPT = ("metrics",)
+# Endpoints whose responses stream for as long as the client stays, they
+# don't take one of the RESUME_MAX_IN_FLIGHT slots
+STREAMING = ("resume_changes",)
+
+# key hash, tokens, time of the last update
+_SLOT = struct.Struct("<Qdd")
+
+
+def parse_budget(value):
+    '''
+    Parse a "rate/burst" or "rate" budget into (rate, burst), or None when
+    there is no budget
+    '''
+    if not value:
+        return None
+    rate, _, burst = value.partition("/")
+    rate = float(rate)
+    return rate, float(burst) if burst else max(rate, 1.0)
+
+
+def _refill(tokens, last, now, rate, burst):
+    '''
+    Take a token from a bucket. Returns the new tokens and the seconds to
+    wait for a token, 0 if one was taken
+    '''
+    tokens = min(burst, tokens + (now - last) * rate)
+    if tokens >= 1:
+        return tokens - 1, 0.0
+    return tokens, (1 - tokens) / rate
+
+
+class TokenBuckets:
+    '''
+    Token buckets of the clients of this process
+    '''
+
+    def __init__(self, max_clients=MAX_CLIENTS):
+        self.max_clients = max_clients
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        '''
+        Take a token from the bucket of key. Returns 0 if there was one, the
+        seconds until there is one otherwise
+        '''
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.pop(key, (burst, now))
+            tokens, wait = _refill(tokens, last, now, rate, burst)
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+        return wait
+
+    def reset(self):
+        '''
+        Forget every bucket
+        '''
+        with self._lock:
+            self._buckets.clear()
+
+
+class SharedTokenBuckets:
+    '''
+    Token buckets in a table file mapped in memory, used by every process of
+    the machine that opens the same name. A lock file serializes the
+    processes. Unlike a multiprocessing SharedMemory, which the resource
+    tracker of each process removes when it exits, the table stays until
+    it is closed with unlink
+    '''
+
+    def __init__(self, name=SHARED_NAME, slots=SHARED_SLOTS):
+        self.slots = slots
+        path = os.path.join(tempfile.gettempdir(), name)
+        # pylint: disable-next=consider-using-with
+        self._lock_file = open(f"{path}.lock", "ab")
+        self._table_path = f"{path}.buckets"
+        size = slots * _SLOT.size
+        with open(self._table_path, "a+b") as table:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            try:
+                # zero filled, so every slot starts empty
+                if os.fstat(table.fileno()).st_size < size:
+                    table.truncate(size)
+            finally:
+                fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+            self._memory = mmap.mmap(table.fileno(), size)
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        '''
+        Take a token from the bucket of key. Returns 0 if there was one, the
+        seconds until there is one otherwise
+        '''
+        # 0 marks an empty slot
+        key_hash = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(),
+                                  "little") or 1
+        offset = key_hash % self.slots * _SLOT.size
+        # the thread lock first, as the file lock doesn't exclude threads
+        with self._lock:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            try:
+                now = time.monotonic()
+                slot_hash, tokens, last = _SLOT.unpack_from(self._memory, offset)
+                if slot_hash != key_hash:
+                    tokens, last = burst, now
+                tokens, wait = _refill(tokens, last, now, rate, burst)
+                _SLOT.pack_into(self._memory, offset, key_hash, tokens, now)
+            finally:
+                fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+        return wait
+
+    def reset(self):
+        '''
+        Forget every bucket
+        '''
+        with self._lock:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            try:
+                self._memory[:] = bytes(len(self._memory))
+            finally:
+                fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def close(self, unlink=False):
+        '''
+        Detach from the table, and remove it and its lock file if unlink is true
+        '''
+        self._lock_file.close()
+        self._memory.close()
+        if unlink:
+            os.remove(self._table_path)
+            os.remove(self._lock_file.name)
+
+
+class Admission:
+    '''
+    Decides whether a request is handled: the budgets of its client and the
+    bound on requests in flight
+    '''
+
+    def __init__(self, buckets, budgets, max_in_flight=0, queue_timeout=0.1):
+        self.buckets = buckets
+        # {"read": (rate, burst) or None, "write": ...}
+        self.budgets = budgets
+        self.queue_timeout = queue_timeout
+        self.slots = threading.BoundedSemaphore(max_in_flight) if max_in_flight else None
+
+    def _clients(self):
+        clients = [f"ip:{request.remote_addr}"]
+        if g.get("user_id") is not None:
+            clients.append(f"user:{g.user_id}")
+        return clients
+
+    def admit(self):
+        '''
+        Return the seconds the request has to wait for a token, 0 if it is
+        within its budgets
+        '''
+        kind = "read" if request.method in READ_METHODS else "write"
+        budget = self.budgets.get(kind)
+        if budget is None:
+            return 0.0
+        # charge every bucket, so a client over budget keeps being refused
+        waits = [self.buckets.take(f"{kind}/{client}", *budget) for client in self._clients()]
+        return max(waits)
+
+    def enter(self):
+        '''
+        Wait for a slot to handle the request. Returns False if none freed up
+        in time
+        '''
+        if self.slots is None:
+            return True
+        return self.slots.acquire(timeout=self.queue_timeout)
+
+    def leave(self):
+        '''
+        Free the slot of a request
+        '''
+        self.slots.release()
+
+
+def _refuse(status, message, retry_after):
+    response = jsonify({"error": message})
+    response.status_code = status
+    response.headers["Retry-After"] = str(max(1, math.ceil(retry_after)))
+    return response
+
+
+def limit(app, policy):
+    '''
+    Apply an admission policy to every request of a Flask app
+    '''
+    @app.before_request
+    def admit_request():
+        if request.endpoint in EXEMPT:
+            return None
+        wait = policy.admit()
+        if wait:
+            return _refuse(429, "Too many requests", wait)
+        if request.endpoint not in STREAMING and not policy.enter():
+            return _refuse(503, "Server busy", policy.queue_timeout)
+        g.admitted = request.endpoint not in STREAMING
+        return None
+
+    @app.teardown_request
+    def release_request(_exception):
+        if g.pop("admitted", False) and policy.slots is not None:
+            policy.leave()
+
+
+admission = Admission(
+    SharedTokenBuckets() if os.environ.get("RESUME_RATE_SHARED") == "1" else TokenBuckets(),
+    {"read": parse_budget(os.environ.get("RESUME_RATE_READ")),
+     "write": parse_budget(os.environ.get("RESUME_RATE_WRITE"))},
+    int(os.environ.get("RESUME_MAX_IN_FLIGHT", "0")),
+    int(os.environ.get("RESUME_QUEUE_TIMEOUT_MS", "100")) / 1000,
+)
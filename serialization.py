@@ -0,0 +1,87 @@
+'''
+How records are turned into JSON. The app uses ResumeJSONProvider so every
+response, cached or not, goes through record_to_dict.
+
+The fields of each model are looked up once and read with a single
+attrgetter per class. When orjson is installed it encodes the responses,
+otherwise the json module does
+'''
+
+import dataclasses
+from operator import attrgetter
+from flask.json.provider import DefaultJSONProvider
+from logos import public_logo
+from metrics import timed
+
+try:
+    import orjson
+    # pylint can't see the members of the compiled module
+    # pylint: disable=no-member
+    # records and dates go through default, so they look the same with both
+    ORJSON_OPTION = (orjson.OPT_PASSTHROUGH_DATACLASS | orjson.OPT_PASSTHROUGH_DATETIME
+                     | orjson.OPT_NON_STR_KEYS)
+    SORT_KEYS = orjson.OPT_SORT_KEYS
+    # pylint: enable=no-member
+except ImportError:
+    orjson = None
+
+# (names, getter) of each model class, filled on first use
+_ACCESSORS = {}
+# what jsonify asks for outside debug mode, the only layout orjson writes
+COMPACT = {"separators": (",", ":")}
+
+
+def _accessor(cls):
+    '''
+    Return the field names of a dataclass and a function returning the values
+    of those fields of a record as a tuple
+    '''
+    accessor = _ACCESSORS.get(cls)
+    if accessor is None:
+        names = tuple(field.name for field in dataclasses.fields(cls))
+        getter = attrgetter(*names)
+        if len(names) == 1:
+            # attrgetter of one name returns the value, not a tuple
+            single = getter
+
+            def getter(record):  # pylint: disable=function-redefined
+                return (single(record),)
+        accessor = _ACCESSORS[cls] = (names, getter)
+    return accessor
+
+
+def record_to_dict(record, public=True):
+    '''
+    Return the fields of a record as a dict, with the logo as sent to clients
+    unless public is False (the export keeps the stored values)
+    '''
+    names, getter = _accessor(type(record))
+    fields = dict(zip(names, getter(record)))
+    if public and "logo" in fields:
+        fields["logo"] = public_logo(fields["logo"])
+    return fields
+
+
+class ResumeJSONProvider(DefaultJSONProvider):
+    '''
+    JSON provider that serializes records with record_to_dict, with orjson
+    when it is installed
+    '''
+
+    @staticmethod
+    def default(o):
+        '''
+        Serialize records, and anything else the default provider knows
+        '''
+        if dataclasses.is_dataclass(o) and not isinstance(o, type):
+            return record_to_dict(o)
+        return DefaultJSONProvider.default(o)
+
+    @timed("serialize")
+    def dumps(self, obj, **kwargs):
+        # orjson can't indent like the debug mode responses, leave those to json
+        if orjson is None or kwargs not in ({}, COMPACT):
+            return super().dumps(obj, **kwargs)
+        option = ORJSON_OPTION | SORT_KEYS if self.sort_keys else ORJSON_OPTION
+        encoded = orjson.dumps(obj, default=self.default, option=option)  # pylint: disable=no-member
+        return encoded.decode()
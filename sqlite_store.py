@@ -0,0 +1,518 @@
+'''
+SQLite storage engine for the resume sections. Every section is a table with
+an INTEGER PRIMARY KEY, so several worker processes can share one database
+file and see the same data. The database runs in WAL mode so readers do not
+block the writer
+'''
+
+import dataclasses
+import json
+import queue
+import sqlite3
+import time
+from contextlib import contextmanager
+from cache import JSONCache
+from indexes import DATE_FIELDS, EXACT_FIELDS, TEXT_FIELDS, PRESENT, parse_date, tokenize
+from models import SECTION_MODELS
+from store import DEFAULT_ID_MODE, POSITIONAL, STABLE, _to_int
+
+POOL_SIZE = 8
+
+
+def _words(texts):
+    '''
+    Return the tokens of the text fields of a record as the words column
+    holds them: sorted, with a space around each one, so a token is found
+    with instr(words, " token ") and matches whole words like the inverted
+    index of the in-memory sections
+    '''
+    tokens = set()
+    for text in texts:
+        tokens |= tokenize(text)
+    return f" {' '.join(sorted(tokens))} "
+
+
+class _Rollback(Exception):
+    '''
+    Raised inside a transaction to roll it back
+    '''
+
+
+class SqliteEngine:
+    '''
+    Owns the database file and a pool of connections shared by its sections.
+    Statements always use the same SQL with ? parameters, so sqlite3 keeps them
+    prepared in its per connection statement cache
+    '''
+
+    def __init__(self, path, pool_size=POOL_SIZE):
+        self.path = path
+        self._pool = queue.Queue()
+        for _ in range(pool_size):
+            self._pool.put(self._connect())
+        with self.connection() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (section TEXT PRIMARY KEY, "
+                         "version INTEGER NOT NULL, last_modified REAL NOT NULL, "
+                         "seeded INTEGER NOT NULL DEFAULT 0)")
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(meta)")}
+            if "seeded" not in columns:
+                # the sections of a database from before the column were
+                # seeded when it was first opened
+                conn.execute("ALTER TABLE meta ADD COLUMN seeded INTEGER NOT NULL DEFAULT 1")
+            for section in SECTION_MODELS:
+                conn.execute(f"CREATE TABLE IF NOT EXISTS {section} "
+                             "(id INTEGER PRIMARY KEY AUTOINCREMENT, body TEXT NOT NULL)")
+                conn.execute("INSERT OR IGNORE INTO meta VALUES (?, 0, ?, 0)",
+                             (section, time.time()))
+                # secondary indexes on the fields that can be filtered on
+                for field in EXACT_FIELDS.get(section, ()):
+                    conn.execute(f"CREATE INDEX IF NOT EXISTS {section}_{field} "
+                                 f"ON {section} (json_extract(body, '$.{field}'))")
+                self._add_date_columns(conn, section)
+                self._add_words_column(conn, section)
+
+    def _add_date_columns(self, conn, section):
+        '''
+        Add an indexed <field>_ord column with the parsed month ordinal of every
+        date field of a section, and fill it for rows written before it existed
+        '''
+        columns = {row[1] for row in conn.execute(f"PRAGMA table_info({section})")}
+        for field in DATE_FIELDS.get(section, ()):
+            if f"{field}_ord" not in columns:
+                conn.execute(f"ALTER TABLE {section} ADD COLUMN {field}_ord INTEGER")
+                rows = conn.execute(f"SELECT id, json_extract(body, '$.{field}') "
+                                    f"FROM {section}").fetchall()
+                conn.executemany(f"UPDATE {section} SET {field}_ord = ? WHERE id = ?",
+                                 [(parse_date(value), key) for key, value in rows])
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {section}_{field}_ord "
+                         f"ON {section} ({field}_ord)")
+
+    def _add_words_column(self, conn, section):
+        '''
+        Add the words column searched by q=, and fill it for rows written
+        before it existed
+        '''
+        columns = {row[1] for row in conn.execute(f"PRAGMA table_info({section})")}
+        if "words" in columns:
+            return
+        conn.execute(f"ALTER TABLE {section} ADD COLUMN words TEXT NOT NULL DEFAULT ''")
+        fields = TEXT_FIELDS.get(section, ())
+        rows = conn.execute(f"SELECT id, body FROM {section}").fetchall()
+        conn.executemany(f"UPDATE {section} SET words = ? WHERE id = ?",
+                         [(_words(json.loads(body)[field] for field in fields), key)
+                          for key, body in rows])
+
+    def _connect(self):
+        '''
+        Open a connection in WAL mode with durable commits
+        '''
+        conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False,
+                               cached_statements=256)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=FULL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        return conn
+
+    @contextmanager
+    def connection(self):
+        '''
+        Borrow a connection from the pool
+        '''
+        conn = self._pool.get()
+        try:
+            yield conn
+        finally:
+            self._pool.put(conn)
+
+    @contextmanager
+    def transaction(self):
+        '''
+        Borrow a connection and run a write transaction on it
+        '''
+        with self.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def section(self, name, id_mode=POSITIONAL):
+        '''
+        Return the section stored in the table with the given name
+        '''
+        return SqliteSection(self, name, id_mode)
+
+    def load(self, seed, id_mode=None):
+        '''
+        Build the dict of sections used by the app. The seed records of a
+        section are only written the first time the database is loaded
+        '''
+        data = {name: self.section(name, id_mode or DEFAULT_ID_MODE) for name in seed}
+        for name, records in seed.items():
+            data[name].seed(records)
+        return data
+
+    def close(self):
+        '''
+        Close every connection of the pool
+        '''
+        while not self._pool.empty():
+            self._pool.get().close()
+
+
+class SqliteSection:
+    '''
+    Section stored in a SQLite table. In positional mode an id is the position
+    of the row ordered by primary key, in stable mode it is the primary key.
+    The version of every section is kept in the meta table, so the JSON cache
+    of a process is dropped when another process writes to the section
+    '''
+
+    # the (ChangeFeed, section name) changes are published to, see changes.py
+    feed = None
+
+    def __init__(self, engine, name, id_mode=POSITIONAL):
+        if id_mode not in (POSITIONAL, STABLE):
+            raise ValueError(f"Unknown id mode: {id_mode}")
+        self.engine = engine
+        self.name = name
+        self.id_mode = id_mode
+        date_fields = DATE_FIELDS.get(name, ())
+        self._sql = {
+            "insert": (f"INSERT INTO {name} (body{''.join(f', {f}_ord' for f in date_fields)}, "
+                       f"words) VALUES (?{', ?' * len(date_fields)}, ?)"),
+            "update": (f"UPDATE {name} SET body = ?"
+                       f"{''.join(f', {f}_ord = ?' for f in date_fields)}, words = ? "
+                       "WHERE id = ?"),
+        }
+        self._cache = JSONCache()
+        self._version = None
+        self._last_modified = time.time()
+
+    def _encode(self, record):
+        return json.dumps(dataclasses.asdict(record))
+
+    def _publish(self, kind, record_id, record=None):
+        '''
+        Add a change to the feed, if there is one. Called inside the write
+        transaction, so changes are numbered in the order they were applied
+        '''
+        if self.feed is not None:
+            feed, name = self.feed
+            feed.publish(name, kind, int(record_id), record)
+
+    def _columns(self, record):
+        '''
+        Return the values of the columns of a row: the body, the parsed dates
+        and the words
+        '''
+        return (
+            self._encode(record),
+            *(parse_date(getattr(record, field)) for field in DATE_FIELDS.get(self.name, ())),
+            _words(getattr(record, field) for field in TEXT_FIELDS.get(self.name, ())),
+        )
+
+    def _insert(self, conn, record):
+        '''
+        Insert a record with its parsed dates and words and return its primary key
+        '''
+        return conn.execute(self._sql["insert"], self._columns(record)).lastrowid
+
+    def _write(self, conn, key, record):
+        '''
+        Overwrite the row with the given primary key with a record, its dates
+        and its words
+        '''
+        conn.execute(self._sql["update"], (*self._columns(record), key))
+
+    def _decode(self, body):
+        return SECTION_MODELS[self.name](**json.loads(body))
+
+    def _sync(self):
+        '''
+        Read the version of the section and drop the cache if someone else
+        changed the section since the last read
+        '''
+        with self.engine.connection() as conn:
+            version, last_modified = conn.execute(
+                "SELECT version, last_modified FROM meta WHERE section = ?",
+                (self.name,)).fetchone()
+        if version != self._version:
+            self._cache.clear()
+            self._version = version
+            self._last_modified = last_modified
+
+    def _touch(self, conn, key=None):
+        '''
+        Bump the version of the section inside the current write transaction
+        '''
+        now = time.time()
+        old_version = conn.execute("SELECT version FROM meta WHERE section = ?",
+                                   (self.name,)).fetchone()[0]
+        conn.execute("UPDATE meta SET version = ?, last_modified = ? WHERE section = ?",
+                     (old_version + 1, now, self.name))
+        if old_version == self._version:
+            self._cache.invalidate(key)
+        else:
+            self._cache.clear()
+        self._version = old_version + 1
+        self._last_modified = now
+
+    def _key_of(self, conn, index):
+        '''
+        Return the primary key of the row with the given id or None
+        '''
+        index = _to_int(index)
+        if index is None or index < 0:
+            return None
+        if self.id_mode == POSITIONAL:
+            row = conn.execute(f"SELECT id FROM {self.name} ORDER BY id LIMIT 1 OFFSET ?",
+                               (index,)).fetchone()
+        else:
+            row = conn.execute(f"SELECT id FROM {self.name} WHERE id = ?", (index,)).fetchone()
+        return None if row is None else row[0]
+
+    @property
+    def cache(self):
+        '''
+        The JSON cache of this process, valid for the current version
+        '''
+        self._sync()
+        return self._cache
+
+    @property
+    def version(self):
+        '''
+        The version of the section, bumped by every write from any process
+        '''
+        self._sync()
+        return self._version
+
+    @property
+    def last_modified(self):
+        '''
+        The time of the last write to the section from any process
+        '''
+        self._sync()
+        return self._last_modified
+
+    def __len__(self):
+        with self.engine.connection() as conn:
+            return conn.execute(f"SELECT COUNT(*) FROM {self.name}").fetchone()[0]
+
+    def __iter__(self):
+        with self.engine.connection() as conn:
+            rows = conn.execute(f"SELECT body FROM {self.name} ORDER BY id").fetchall()
+        return iter([self._decode(body) for body, in rows])
+
+    def items(self):
+        '''
+        Return (id, record) pairs in order
+        '''
+        with self.engine.connection() as conn:
+            rows = conn.execute(f"SELECT id, body FROM {self.name} ORDER BY id").fetchall()
+        if self.id_mode == POSITIONAL:
+            return [(position, self._decode(body)) for position, (_, body) in enumerate(rows)]
+        return [(key, self._decode(body)) for key, body in rows]
+
+    def append(self, record):
+        '''
+        Add a record at the end and return its id
+        '''
+        with self.engine.transaction() as conn:
+            key = self._insert(conn, record)
+            self._touch(conn)
+            if self.id_mode == POSITIONAL:
+                key = conn.execute(f"SELECT COUNT(*) FROM {self.name}").fetchone()[0] - 1
+            self._publish("create", key, record)
+        return key
+
+    def extend(self, records):
+        '''
+        Add several records at the end in one transaction and return their ids
+        '''
+        with self.engine.transaction() as conn:
+            count = conn.execute(f"SELECT COUNT(*) FROM {self.name}").fetchone()[0]
+            ids = []
+            for record in records:
+                key = self._insert(conn, record)
+                ids.append(count + len(ids) if self.id_mode == POSITIONAL else key)
+                self._publish("create", ids[-1], record)
+            self._touch(conn)
+        return ids
+
+    def get(self, index):
+        '''
+        Return the record with the given id or None if not found
+        '''
+        with self.engine.connection() as conn:
+            key = self._key_of(conn, index)
+            if key is None:
+                return None
+            row = conn.execute(f"SELECT body FROM {self.name} WHERE id = ?", (key,)).fetchone()
+        return None if row is None else self._decode(row[0])
+
+    def key_of(self, index):
+        '''
+        Return the key of the record with the given id or None if not found
+        '''
+        with self.engine.connection() as conn:
+            return self._key_of(conn, index)
+
+    def update(self, index, change):
+        '''
+        Replace the record with the given id by change(record) inside one
+        write transaction, returns the new record or None if not found. If
+        change returns the record itself nothing is written
+        '''
+        with self.engine.transaction() as conn:
+            key = self._key_of(conn, index)
+            if key is None:
+                return None
+            body = conn.execute(f"SELECT body FROM {self.name} WHERE id = ?",
+                                (key,)).fetchone()[0]
+            old = self._decode(body)
+            record = change(old)
+            if record is old:
+                return record
+            self._write(conn, key, record)
+            self._touch(conn, key)
+            self._publish("update", int(index), record)
+        return record
+
+    def replace(self, index, record):
+        '''
+        Replace the record with the given id, returns False if not found
+        '''
+        return self.update(index, lambda _: record) is not None
+
+    def delete(self, index):
+        '''
+        Remove and return the record with the given id or None if not found
+        '''
+        with self.engine.transaction() as conn:
+            key = self._key_of(conn, index)
+            if key is None:
+                return None
+            body = conn.execute(f"SELECT body FROM {self.name} WHERE id = ?",
+                                (key,)).fetchone()[0]
+            conn.execute(f"DELETE FROM {self.name} WHERE id = ?", (key,))
+            self._touch(conn, key)
+            self._publish("delete", int(index))
+        return self._decode(body)
+
+    def apply(self, operations):
+        '''
+        Apply a list of (kind, index, value) operations in one transaction,
+        see store.PositionalSection.apply
+        '''
+        results = []
+        # (kind, id, record) of every write, in order, and the keys it changed
+        published = []
+        touched = []
+        try:
+            with self.engine.transaction() as conn:
+                count = conn.execute(f"SELECT COUNT(*) FROM {self.name}").fetchone()[0]
+                for kind, index, value in operations:
+                    if kind == "create":
+                        key = self._insert(conn, value)
+                        results.append(count if self.id_mode == POSITIONAL else key)
+                        published.append((kind, results[-1], value))
+                        count += 1
+                        continue
+                    key = self._key_of(conn, index)
+                    if key is None:
+                        results.append(None)
+                        raise _Rollback
+                    record = self._decode(conn.execute(
+                        f"SELECT body FROM {self.name} WHERE id = ?", (key,)).fetchone()[0])
+                    if kind == "delete":
+                        conn.execute(f"DELETE FROM {self.name} WHERE id = ?", (key,))
+                        count -= 1
+                        results.append(record)
+                        published.append((kind, int(index), None))
+                        touched.append(key)
+                        continue
+                    results.append(value(record))
+                    # a change returning the record itself writes nothing
+                    if results[-1] is not record:
+                        self._write(conn, key, results[-1])
+                        published.append((kind, int(index), results[-1]))
+                        touched.append(key)
+                if published:
+                    self._touch(conn)
+                for kind, record_id, record in published:
+                    self._publish(kind, record_id, record)
+        except _Rollback:
+            return results
+        for key in touched:
+            self._cache.invalidate(key)
+        return results
+
+    def seed(self, records):
+        '''
+        Write the seed records of the section unless it was seeded before,
+        even if its records have been deleted since. The check and the writes
+        are one transaction, so only one of several workers starting at once
+        seeds the section
+        '''
+        with self.engine.transaction() as conn:
+            seeded = conn.execute("SELECT seeded FROM meta WHERE section = ?",
+                                  (self.name,)).fetchone()[0]
+            if seeded:
+                return
+            for record in records:
+                self._insert(conn, record)
+            conn.execute("UPDATE meta SET seeded = 1 WHERE section = ?", (self.name,))
+            self._touch(conn)
+
+    def _conditions(self, filters, query=None, date_range=None):
+        '''
+        Return the SQL conditions and parameters of a search. Filters use the
+        json_extract indexes, dates the indexed <field>_ord columns, and the
+        tokens of query are looked up as whole words in the words column
+        '''
+        conditions = [f"json_extract(body, '$.{field}') = ?" for field in filters]
+        params = list(filters.values())
+        for token in tokenize(query or ""):
+            conditions.append("instr(words, ?) > 0")
+            params.append(f" {token} ")
+        if date_range is not None:
+            field, low, high = date_range
+            conditions.append(f"{field}_ord BETWEEN ? AND ?")
+            params += [-1 if low is None else low, PRESENT if high is None else high]
+        return conditions, params
+
+    def search(self, filters, query=None, date_range=None, sort=None):
+        '''
+        Return the records matching every field=value filter and containing
+        every word of query, see store.MemorySection.search
+        '''
+        conditions, params = self._conditions(filters, query, date_range)
+        order = "id"
+        if sort is not None:
+            field, reverse = sort
+            order = f"{field}_ord IS NULL, {field}_ord {'DESC' if reverse else 'ASC'}, id"
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self.engine.connection() as conn:
+            rows = conn.execute(f"SELECT body FROM {self.name} {where} ORDER BY {order}",
+                                params).fetchall()
+        return [self._decode(body) for body, in rows]
+
+    def page(self, after=None, limit=None):
+        '''
+        Return up to limit records that come after the record with key after,
+        plus the key to continue from or None if this is the last page
+        '''
+        with self.engine.connection() as conn:
+            rows = conn.execute(f"SELECT id, body FROM {self.name} WHERE id > ? "
+                                "ORDER BY id LIMIT ?",
+                                (-1 if after is None else after,
+                                 -1 if limit is None else limit + 1)).fetchall()
+        next_after = None
+        if limit is not None and len(rows) > limit:
+            rows = rows[:limit]
+            next_after = rows[-1][0]
+        return [self._decode(body) for _, body in rows], next_after
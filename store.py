@@ -0,0 +1,731 @@
+'''
+Storage for the resume sections. Each section holds its records in order and
+hands out the ids that the API returns on POST and accepts as ?index=
+'''
+
+import functools
+import os
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from operator import itemgetter
+from cache import JSONCache
+from indexes import DATE_FIELDS, EXACT_FIELDS, TEXT_FIELDS, SectionIndex
+
+POSITIONAL = "positional"
+STABLE = "stable"
+ID_MODES = (POSITIONAL, STABLE)
+
+# "positional" keeps the original behavior where an id is the position of the
+# record in the list, "stable" gives every record an id that survives deletes
+DEFAULT_ID_MODE = os.environ.get("RESUME_ID_MODE", POSITIONAL)
+
+# "memory" keeps the sections in this process, "sqlite" stores them in the
+# database file at RESUME_SQLITE_PATH so every worker process shares them
+DEFAULT_STORAGE = os.environ.get("RESUME_STORAGE", "memory")
+SQLITE_PATH = os.environ.get("RESUME_SQLITE_PATH", "resume.db")
+
+
+# Positional sections compact their slots only past this size
+COMPACT_MIN = 64
+
+
+def _to_int(index):
+    '''
+    Convert an ?index= value to an int, or None if it is not a number
+    '''
+    try:
+        return int(index)
+    except (TypeError, ValueError):
+        return None
+
+
+def _durable(write):
+    '''
+    Decorate a write method so that, once it has released the section lock,
+    it waits until the journal made its changes durable
+    '''
+    @functools.wraps(write)
+    def durable_write(self, *args):
+        result = write(self, *args)
+        if self.journal is not None:
+            self.journal.wait()
+        return result
+    return durable_write
+
+
+class MemorySection:
+    '''
+    What the in-memory sections share: the writer lock, the JSON cache, the
+    version and last-modified time, and the secondary indexes.
+
+    A journal (see wal.py) can be attached to log every write, and a feed
+    (see changes.py) to number every change. Both happen while the lock is
+    held, so they have the writes in the order they were applied
+    '''
+    id_mode = None
+    journal = None
+    # the (ChangeFeed, section name) changes are published to
+    feed = None
+
+    def __init__(self, index=None):
+        self._lock = threading.Lock()
+        self.cache = JSONCache()
+        self.version = 0
+        self.last_modified = time.time()
+        self.index = index or SectionIndex()
+
+    def _touch(self, key=None):
+        '''
+        Record a change to the section (and to the record with key, if given)
+        '''
+        self.version += 1
+        self.last_modified = time.time()
+        self.cache.invalidate(key)
+
+    def _reindex(self, changes):
+        '''
+        Replay (added, key, record) changes on the indexes, in order
+        '''
+        for added, key, record in changes:
+            if added:
+                self.index.add(key, record)
+            else:
+                self.index.remove(key, record)
+
+    def _log(self, kind, index, value):
+        '''
+        Log a write to the journal, if there is one. Must hold the lock
+        '''
+        if self.journal is not None:
+            self.journal.append(kind, index, value)
+
+    def _publish(self, kind, record_id, record=None):
+        '''
+        Add a change to the feed, if there is one. Must hold the lock
+        '''
+        if self.feed is not None:
+            feed, name = self.feed
+            feed.publish(name, kind, int(record_id), record)
+
+    def _state(self):
+        '''
+        Return the next key and the (key, record) pairs. Must hold the lock
+        '''
+        raise NotImplementedError
+
+    def snapshot(self):
+        '''
+        Return the journal position, the next key and the (key, record) pairs
+        of the section, all taken at the same moment
+        '''
+        with self._lock:
+            position = None if self.journal is None else self.journal.position()
+            return (position, *self._state())
+
+    def restore(self, next_key, items):
+        '''
+        Replace the contents of the section with the (key, record) pairs of a
+        snapshot. Nothing is logged
+        '''
+        raise NotImplementedError
+
+    def replace(self, index, record):
+        '''
+        Replace the record with the given id, returns False if not found
+        '''
+        return self.update(index, lambda _: record) is not None
+
+    def update(self, index, change):
+        '''
+        Replace the record with the given id by change(record) while holding
+        the lock, returns the new record or None if not found. If change
+        returns the record itself nothing is written
+        '''
+        raise NotImplementedError
+
+    def records_for(self, keys):
+        '''
+        Return the records with the given keys, in key order
+        '''
+        raise NotImplementedError
+
+    def search(self, filters, query=None, date_range=None, sort=None):
+        '''
+        Return the records matching every field=value filter and containing
+        every word of query, using the secondary indexes. date_range is
+        (field, low, high) with month ordinals, sort is (field, reverse) and
+        orders the records by a date field, see SectionIndex.query
+        '''
+        keys = self.index.query(filters, query, date_range, sort)
+        return list(self) if keys is None else self.records_for(keys)
+
+
+class LiveSlots:
+    '''
+    Fenwick tree over the slots of a positional section, counting the slots
+    that hold a live record. Finding the slot of the n-th live record and
+    marking a slot dead both cost O(log n)
+    '''
+
+    def __init__(self, size=0):
+        self.count = size
+        # tree[i] is the number of live slots in (i - lowbit(i), i], 1-based
+        tree = [0] + [1] * size
+        for i in range(1, size + 1):
+            parent = i + (i & -i)
+            if parent <= size:
+                tree[parent] += tree[i]
+        self.tree = tree
+
+    def _prefix(self, i):
+        total = 0
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    def append(self):
+        '''
+        Add a live slot at the end
+        '''
+        i = len(self.tree)
+        self.tree.append(1 + self._prefix(i - 1) - self._prefix(i - (i & -i)))
+        self.count += 1
+
+    def kill(self, slot):
+        '''
+        Mark a slot (0-based) as dead
+        '''
+        i = slot + 1
+        while i < len(self.tree):
+            self.tree[i] -= 1
+            i += i & -i
+        self.count -= 1
+
+    def find(self, rank):
+        '''
+        Return the slot (0-based) of the live record at position rank
+        '''
+        tree = self.tree
+        position = 0
+        remaining = rank + 1
+        step = 1 << (len(tree) - 1).bit_length()
+        while step:
+            following = position + step
+            if following < len(tree) and tree[following] < remaining:
+                position = following
+                remaining -= tree[following]
+            step >>= 1
+        return position
+
+
+class PositionalSection(MemorySection):
+    '''
+    Section whose ids are list positions. Deleting a record shifts the ids
+    of every record after it, exactly like the original list based API.
+
+    Records are stored as (key, record) tuples in slots. Updates replace the
+    tuple in its slot and deletes leave a (key, None) tombstone, so neither
+    moves the other records. A LiveSlots tree maps positions to slots, and
+    the slots are compacted once most of them are tombstones.
+
+    Writers hold the section lock. Readers never take it unless they land on
+    a slot a writer is changing: every slot holds one tuple, so a reader only
+    ever needs a single list operation, which is atomic, to see a consistent
+    record
+    '''
+    id_mode = POSITIONAL
+
+    def __init__(self, records=(), index=None):
+        super().__init__(index)
+        # every record gets a key that never changes, the keys stay sorted
+        # because records are only ever added at the end
+        entries = list(enumerate(records))
+        # the slots and their tree are swapped together by compaction
+        self._layout = (entries, LiveSlots(len(entries)))
+        self._next_key = len(entries)
+        self._reindex((True, key, record) for key, record in entries)
+
+    def __len__(self):
+        return self._layout[1].count
+
+    def _slot(self, index, locked=False):
+        '''
+        Return the slot and the (key, record) of the record with the given id,
+        or None if not found
+        '''
+        index = _to_int(index)
+        if index is None or index < 0:
+            return None
+        entries, slots = self._layout
+        if index >= slots.count:
+            return None
+        slot = slots.find(index)
+        entry = entries[slot] if slot < len(entries) else None
+        if entry is not None and entry[1] is not None:
+            return slot, entry
+        if locked:
+            return None
+        # a writer is halfway through changing the slots, look again once
+        # it is done
+        with self._lock:
+            return self._slot(index, locked=True)
+
+    def _live(self):
+        '''
+        Return the (key, record) pairs of the live records, in order
+        '''
+        return [entry for entry in self._layout[0][:] if entry[1] is not None]
+
+    def _compact(self):
+        '''
+        Drop the tombstones once they fill more than half of the slots. Must
+        hold the lock
+        '''
+        entries, slots = self._layout
+        if len(entries) > COMPACT_MIN and slots.count * 2 < len(entries):
+            live = [entry for entry in entries if entry[1] is not None]
+            self._layout = (live, LiveSlots(len(live)))
+
+    def __iter__(self):
+        return iter([record for _, record in self._live()])
+
+    def items(self):
+        '''
+        Return (id, record) pairs in order
+        '''
+        return [(position, record) for position, (_, record) in enumerate(self._live())]
+
+    def _state(self):
+        return self._next_key, self._live()
+
+    def restore(self, next_key, items):
+        with self._lock:
+            self._reindex((False, key, record) for key, record in self._live())
+            entries = list(items)
+            self._layout = (entries, LiveSlots(len(entries)))
+            self._next_key = next_key
+            self._reindex((True, key, record) for key, record in entries)
+            self._touch()
+            self.cache.clear()
+
+    @_durable
+    def append(self, record):
+        '''
+        Add a record at the end and return its id
+        '''
+        with self._lock:
+            entries, slots = self._layout
+            # the slot goes in before the tree counts it, so readers never
+            # find a slot that isn't there
+            entries.append((self._next_key, record))
+            slots.append()
+            self.index.add(self._next_key, record)
+            self._next_key += 1
+            self._log("create", None, record)
+            self._publish("create", slots.count - 1, record)
+            self._touch()
+            return slots.count - 1
+
+    @_durable
+    def extend(self, records):
+        '''
+        Add several records at the end under one lock and return their ids
+        '''
+        with self._lock:
+            entries, slots = self._layout
+            start = slots.count
+            new_entries = list(enumerate(records, self._next_key))
+            entries.extend(new_entries)
+            for _ in new_entries:
+                slots.append()
+            self._reindex((True, key, record) for key, record in new_entries)
+            self._next_key += len(new_entries)
+            self._log("extend", None, records)
+            for record_id, (_, record) in enumerate(new_entries, start):
+                self._publish("create", record_id, record)
+            self._touch()
+            return list(range(start, start + len(new_entries)))
+
+    def get(self, index):
+        '''
+        Return the record with the given id or None if not found
+        '''
+        found = self._slot(index)
+        return None if found is None else found[1][1]
+
+    @_durable
+    def update(self, index, change):
+        with self._lock:
+            found = self._slot(index, locked=True)
+            if found is None:
+                return None
+            slot, (key, old) = found
+            record = change(old)
+            if record is old:
+                return record
+            # indexed first, a record the index can't take is not stored
+            self.index.update(key, old, record)
+            self._layout[0][slot] = (key, record)
+            self._log("update", int(index), record)
+            self._publish("update", int(index), record)
+            self._touch(key)
+            return record
+
+    @_durable
+    def delete(self, index):
+        '''
+        Remove and return the record with the given id or None if not found
+        '''
+        with self._lock:
+            found = self._slot(index, locked=True)
+            if found is None:
+                return None
+            slot, (key, record) = found
+            entries, slots = self._layout
+            entries[slot] = (key, None)
+            slots.kill(slot)
+            self.index.remove(key, record)
+            self._log("delete", int(index), None)
+            self._publish("delete", int(index))
+            self._touch(key)
+            self._compact()
+            return record
+
+    @_durable
+    def apply(self, operations):
+        '''
+        Apply a list of (kind, index, value) operations at once. kind is
+        "create" (value is the record), "update" (value is a change function)
+        or "delete". Returns the result of each operation: the id for a create,
+        the new or deleted record otherwise. If an operation targets a missing
+        record its result is None and none of the operations are applied. An
+        update whose change returns the record itself writes nothing, and only
+        the cached records that changed are dropped.
+        The operations work on a compacted copy that replaces the slots in one
+        step, so readers see either none or all of them. Deletes leave
+        tombstones in the copy, which is compacted once at the end, so a
+        batch costs O(n + k log n)
+        '''
+        with self._lock:
+            entries = self._live()
+            slots = LiveSlots(len(entries))
+            next_key = self._next_key
+            results = []
+            changes = []
+            logged = []
+            for kind, index, value in operations:
+                if kind == "create":
+                    entries.append((next_key, value))
+                    slots.append()
+                    changes.append((True, next_key, value))
+                    logged.append((kind, slots.count - 1, value))
+                    next_key += 1
+                    results.append(slots.count - 1)
+                    continue
+                index = _to_int(index)
+                if index is None or not 0 <= index < slots.count:
+                    results.append(None)
+                    return results
+                slot = slots.find(index)
+                key, record = entries[slot]
+                if kind == "update":
+                    results.append(value(record))
+                    if results[-1] is record:
+                        # nothing changes, so nothing is written
+                        continue
+                    entries[slot] = (key, results[-1])
+                    changes += [(False, key, record), (True, key, results[-1])]
+                    logged.append((kind, index, results[-1]))
+                else:
+                    entries[slot] = (key, None)
+                    slots.kill(slot)
+                    changes.append((False, key, record))
+                    logged.append((kind, index, None))
+                    results.append(record)
+            if not logged:
+                return results
+            if slots.count < len(entries):
+                entries = [entry for entry in entries if entry[1] is not None]
+            self._layout = (entries, LiveSlots(len(entries)))
+            self._next_key = next_key
+            self._reindex(changes)
+            self._log("apply", None, logged)
+            for kind, index, record in logged:
+                self._publish(kind, index, record)
+            self._touch()
+            # the records that were updated or deleted
+            for added, key, _ in changes:
+                if not added:
+                    self.cache.invalidate(key)
+            return results
+
+    def key_of(self, index):
+        '''
+        Return the key of the record with the given id or None if not found
+        '''
+        found = self._slot(index)
+        return None if found is None else found[1][0]
+
+    def records_for(self, keys):
+        entries = self._layout[0]
+        records = []
+        for key in keys:
+            position = bisect_left(entries, key, key=itemgetter(0))
+            if position < len(entries):
+                entry_key, record = entries[position]
+                if entry_key == key and record is not None:
+                    records.append(record)
+        return records
+
+    def page(self, after=None, limit=None):
+        '''
+        Return up to limit records that come after the record with key after,
+        plus the key to continue from or None if this is the last page
+        '''
+        entries = self._layout[0]
+        position = 0 if after is None else bisect_right(entries, after, key=itemgetter(0))
+        records = []
+        last = None
+        while position < len(entries):
+            key, record = entries[position]
+            if record is not None:
+                if limit is not None and len(records) == limit:
+                    return records, last
+                records.append(record)
+                last = key
+            position += 1
+        return records, None
+
+
+class StableSection(MemorySection):
+    '''
+    Section whose ids come from a monotonic counter. Records are kept in an
+    id -> record dict (which keeps insertion order), so every operation is O(1)
+    and ids stay valid after other records are deleted.
+
+    Writers hold the section lock, readers never take it and only use single
+    dict operations or copies of the dict, which are atomic
+    '''
+    id_mode = STABLE
+
+    def __init__(self, records=(), index=None):
+        super().__init__(index)
+        self._by_id = {}
+        self._next_id = 0
+        # ids in insertion order, deleted ids are skipped lazily and dropped
+        # once they make up half of the list
+        self._order = []
+        self.extend(list(records))
+        self.version = 0
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def __iter__(self):
+        return iter(list(self._by_id.values()))
+
+    def items(self):
+        '''
+        Return (id, record) pairs in order
+        '''
+        return list(self._by_id.items())
+
+    def _state(self):
+        return self._next_id, list(self._by_id.items())
+
+    def restore(self, next_key, items):
+        with self._lock:
+            self._reindex((False, key, record) for key, record in self._by_id.items())
+            self._by_id = dict(items)
+            self._order = list(self._by_id)
+            self._next_id = next_key
+            self._reindex((True, key, record) for key, record in self._by_id.items())
+            self._touch()
+            self.cache.clear()
+
+    @_durable
+    def append(self, record):
+        '''
+        Add a record at the end and return its id
+        '''
+        with self._lock:
+            new_id = self._next_id
+            self._next_id += 1
+            self._by_id[new_id] = record
+            self._order.append(new_id)
+            self.index.add(new_id, record)
+            self._log("create", None, record)
+            self._publish("create", new_id, record)
+            self._touch()
+            return new_id
+
+    @_durable
+    def extend(self, records):
+        '''
+        Add several records at the end under one lock and return their ids
+        '''
+        with self._lock:
+            ids = list(range(self._next_id, self._next_id + len(records)))
+            self._by_id.update(zip(ids, records))
+            self._order.extend(ids)
+            self._reindex((True, key, record) for key, record in zip(ids, records))
+            self._next_id += len(ids)
+            self._log("extend", None, records)
+            for record_id, record in zip(ids, records):
+                self._publish("create", record_id, record)
+            self._touch()
+            return ids
+
+    def get(self, index):
+        '''
+        Return the record with the given id or None if not found
+        '''
+        return self._by_id.get(_to_int(index))
+
+    @_durable
+    def update(self, index, change):
+        index = _to_int(index)
+        with self._lock:
+            old = self._by_id.get(index)
+            if old is None:
+                return None
+            record = change(old)
+            if record is old:
+                return record
+            # indexed first, a record the index can't take is not stored
+            self.index.update(index, old, record)
+            self._by_id[index] = record
+            self._log("update", index, record)
+            self._publish("update", index, record)
+            self._touch(index)
+            return record
+
+    @_durable
+    def delete(self, index):
+        '''
+        Remove and return the record with the given id or None if not found
+        '''
+        index = _to_int(index)
+        with self._lock:
+            record = self._by_id.pop(index, None)
+            if record is not None:
+                self.index.remove(index, record)
+                self._log("delete", index, None)
+                self._publish("delete", index)
+                self._touch(index)
+                if len(self._by_id) * 2 < len(self._order):
+                    self._order = list(self._by_id)
+            return record
+
+    @_durable
+    def apply(self, operations):
+        '''
+        Apply a list of (kind, index, value) operations at once, see
+        PositionalSection.apply. The operations work on a copy of the dict
+        that replaces it in one step
+        '''
+        with self._lock:
+            by_id = dict(self._by_id)
+            next_id = self._next_id
+            created = []
+            results = []
+            changes = []
+            logged = []
+            for kind, index, value in operations:
+                if kind == "create":
+                    by_id[next_id] = value
+                    changes.append((True, next_id, value))
+                    logged.append((kind, next_id, value))
+                    created.append(next_id)
+                    results.append(next_id)
+                    next_id += 1
+                    continue
+                index = _to_int(index)
+                if index not in by_id:
+                    results.append(None)
+                    return results
+                record = by_id[index]
+                if kind == "update":
+                    updated = value(record)
+                    results.append(updated)
+                    if updated is record:
+                        # nothing changes, so nothing is written
+                        continue
+                    by_id[index] = updated
+                    changes += [(False, index, record), (True, index, updated)]
+                    logged.append((kind, index, updated))
+                else:
+                    del by_id[index]
+                    changes.append((False, index, record))
+                    logged.append((kind, index, None))
+                    results.append(record)
+            if not logged:
+                return results
+            self._by_id = by_id
+            self._next_id = next_id
+            order = self._order + created
+            self._order = list(by_id) if len(by_id) * 2 < len(order) else order
+            self._reindex(changes)
+            self._log("apply", None, logged)
+            for kind, record_id, record in logged:
+                self._publish(kind, record_id, record)
+            self._touch()
+            for kind, index, _ in logged:
+                if kind != "create":
+                    self.cache.invalidate(index)
+            return results
+
+    def key_of(self, index):
+        '''
+        Return the key of the record with the given id or None if not found
+        '''
+        index = _to_int(index)
+        return index if index in self._by_id else None
+
+    def records_for(self, keys):
+        by_id = self._by_id
+        return [by_id[key] for key in keys if key in by_id]
+
+    def page(self, after=None, limit=None):
+        '''
+        Return up to limit records that come after the record with id after,
+        plus the id to continue from or None if this is the last page
+        '''
+        order = self._order
+        position = 0 if after is None else bisect_right(order, after)
+        records = []
+        last = None
+        while position < len(order):
+            record = self._by_id.get(order[position])
+            if record is not None:
+                if limit is not None and len(records) == limit:
+                    return records, last
+                records.append(record)
+                last = order[position]
+            position += 1
+        return records, None
+
+
+def make_section(records=(), id_mode=None, name=None):
+    '''
+    Build a section for the given id mode, defaults to RESUME_ID_MODE. The
+    name of the section picks the fields its secondary indexes cover
+    '''
+    id_mode = id_mode or DEFAULT_ID_MODE
+    index = SectionIndex(EXACT_FIELDS.get(name, ()), TEXT_FIELDS.get(name, ()),
+                         DATE_FIELDS.get(name, ()))
+    if id_mode == POSITIONAL:
+        return PositionalSection(records, index)
+    if id_mode == STABLE:
+        return StableSection(records, index)
+    raise ValueError(f"Unknown id mode: {id_mode}")
+
+
+def make_data(seed, id_mode=None):
+    '''
+    Build the dict of in-memory sections used by the app from the seed records
+    of each section
+    '''
+    return {name: make_section(records, id_mode, name) for name, records in seed.items()}
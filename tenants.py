@@ -0,0 +1,148 @@
+'''
+Resumes of many users, served under /users/<user_id>/resume/... Users are
+spread over shards by a hash of their id. Every shard has its own lock, only
+taken to add a user, and every user has their own sections with their own
+locks, so writes of one user never block another user
+'''
+
+import dataclasses
+import os
+import sys
+import threading
+import zlib
+from changes import attach
+from store import make_data
+
+TENANT_SHARDS = int(os.environ.get("RESUME_TENANT_SHARDS", "16"))
+SECTIONS = ("experience", "education", "skill")
+
+
+class TenantStore:
+    '''
+    Maps user ids to their sections, in TENANT_SHARDS independent shards
+    '''
+
+    def __init__(self, shards=TENANT_SHARDS, id_mode=None):
+        self.id_mode = id_mode
+        self._shards = [{} for _ in range(shards)]
+        self._locks = [threading.Lock() for _ in range(shards)]
+        # sections read by users that don't exist yet, they are never written
+        self.empty = make_data({name: [] for name in SECTIONS}, id_mode)
+
+    def shard_of(self, user_id):
+        '''
+        Return the shard number of a user, the same in every process
+        '''
+        return zlib.crc32(user_id.encode()) % len(self._shards)
+
+    def get(self, user_id):
+        '''
+        Return the sections of a user, or the shared empty sections if the
+        user has none
+        '''
+        tenant = self._shards[self.shard_of(user_id)].get(user_id)
+        return self.empty if tenant is None else tenant
+
+    def resume(self, user_id):
+        '''
+        Return the sections the requests of a user work on. A user without
+        sections gets stand-ins that read like empty sections and only add
+        the user once a record is actually added
+        '''
+        tenant = self._shards[self.shard_of(user_id)].get(user_id)
+        if tenant is not None:
+            return tenant
+        return {name: PendingSection(self, user_id, name) for name in SECTIONS}
+
+    def write(self, user_id, name, method, *args):
+        '''
+        Call a write method of a section of a user. A user without sections
+        is only added if the write adds a record
+        '''
+        shard = self.shard_of(user_id)
+        tenant = self._shards[shard].get(user_id)
+        if tenant is not None:
+            return getattr(tenant[name], method)(*args)
+        with self._locks[shard]:
+            tenant = self._shards[shard].get(user_id)
+            if tenant is not None:
+                return getattr(tenant[name], method)(*args)
+            # nobody else sees the new sections until they are added
+            tenant = make_data({name: [] for name in SECTIONS}, self.id_mode)
+            attach(tenant)
+            result = getattr(tenant[name], method)(*args)
+            if method == "append" or (result and result[-1] is not None):
+                self._shards[shard][user_id] = tenant
+            return result
+
+    def stats(self):
+        '''
+        Return the number of users in each shard
+        '''
+        return [len(shard) for shard in self._shards]
+
+
+class PendingSection:
+    '''
+    Section of a user who has no sections yet. It reads like an empty
+    section, and the writes that add records add the user first. Updates
+    and deletes find nothing, like on any empty section
+    '''
+
+    def __init__(self, store, user_id, name):
+        self._store = store
+        self._user_id = user_id
+        self._name = name
+        self._empty = store.empty[name]
+
+    def __getattr__(self, attribute):
+        return getattr(self._empty, attribute)
+
+    def __len__(self):
+        return 0
+
+    def __iter__(self):
+        return iter(())
+
+    def append(self, record):
+        '''
+        Add the user with this record, see MemorySection.append
+        '''
+        return self._store.write(self._user_id, self._name, "append", record)
+
+    def extend(self, records):
+        '''
+        Add the user with these records, if there are any
+        '''
+        if not records:
+            return []
+        return self._store.write(self._user_id, self._name, "extend", records)
+
+    def apply(self, operations):
+        '''
+        Apply operations, adding the user if they all succeed
+        '''
+        return self._store.write(self._user_id, self._name, "apply", operations)
+
+
+def memory_usage(tenant):
+    '''
+    Estimate the memory used by the records of a user's sections in bytes.
+    Strings shared between records, like interned logos, are counted once
+    '''
+    seen = set()
+    total = 0
+    records = 0
+    for section in tenant.values():
+        for record in section:
+            records += 1
+            total += sys.getsizeof(record)
+            for field in dataclasses.fields(record):
+                value = getattr(record, field.name)
+                if id(value) not in seen:
+                    seen.add(id(value))
+                    total += sys.getsizeof(value)
+    return {"records": records, "bytes": total}
+
+
+tenants = TenantStore()
@@ -1,7 +1,35 @@
+# pylint: disable=too-many-lines
+
 '''
 Tests in Pytest
 '''
-from app import app
+import asyncio
+import gzip
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field as dataclass_field
+from datetime import datetime, timezone
+from typing import Optional
+from app import app, data
+import asgi
+from asgi import application
+from models import Experience, Skill
+from store import make_data, make_section
+from sqlite_store import SqliteEngine
+from validation import compile_validator
+from indexes import parse_date
+from logos import LogoStore, logo_store
+from tenants import tenants
+from changes import ChangeFeed, attach, feed_of
+from metrics import SamplingProfiler
+from ratelimit import SharedTokenBuckets, admission
+import serialization
+from wal import WriteAheadLog
 
 
 def test_client():
@@ -253,6 +281,36 @@ def test_editing_existing_experience_partially():
     assert response.json == full_updated_experience
 
 
+def test_put_wrong_type():
+    '''
+    Put records with fields of the wrong type, through the API and straight
+    into a section
+
+    Check that they are refused and that nothing was written
+    '''
+    item_id = app.test_client().post('/resume/experience', json={
+        "title": "Typed", "company": "Types Co", "start_date": "May 2020",
+        "end_date": "Present", "description": "Checking types", "logo": "example-logo.png"
+    }).json['id']
+    version = data["experience"].version
+    response = app.test_client().put(f'/resume/experience?index={item_id}', json={"title": 5})
+    assert response.status_code == 400
+    response = app.test_client().put('/resume/education?index=0', json={
+        "course": 1, "school": "NYU", "start_date": "October 2022",
+        "end_date": "August 2024", "grade": "86%", "logo": "example-logo.png"})
+    assert response.status_code == 400
+    assert data["experience"].version == version
+    assert app.test_client().get(f'/resume/experience?index={item_id}').json["title"] == "Typed"
+
+    section = make_section([Skill("Typed", "1-2 Years", "example-logo.png")], name="skill")
+    try:
+        section.update(0, lambda skill: Skill(5, skill.proficiency, skill.logo))
+    except AttributeError:
+        pass
+    assert list(section) == [Skill("Typed", "1-2 Years", "example-logo.png")]
+    assert section.search({}, "typed") == list(section)
+
+
 def test_edu_delete():
     '''
     Delete a education and then get all educations. 
@@ -337,3 +395,1110 @@ def test_skill_update():
                                 json=updated_example_skill)
     response = app.test_client().get('/resume/skill')
     assert response.json[item_id] == updated_example_skill
+
+
+def test_duplicate_post_ids():
+    '''
+    Post the same skill twice
+
+    Check that each copy gets its own id
+    '''
+    example_skill = {
+        "name": "Go",
+        "proficiency": "1-2 years",
+        "logo": "example-logo.png"
+    }
+    id1 = app.test_client().post('/resume/skill', json=example_skill).json['id']
+    id2 = app.test_client().post('/resume/skill', json=example_skill).json['id']
+    assert id2 == id1 + 1
+
+
+def test_stable_ids_survive_delete():
+    '''
+    Delete a record from a section in stable id mode
+
+    Check that the ids of the other records still resolve
+    '''
+    section = make_section(id_mode="stable")
+    first = section.append(Skill("Python", "1-2 Years", "example-logo.png"))
+    second = section.append(Skill("Python", "1-2 Years", "example-logo.png"))
+    assert first != second
+
+    section.delete(first)
+    assert section.get(first) is None
+    assert section.get(second) is not None
+    third = section.append(Skill("Go", "1 Year", "example-logo.png"))
+    assert third not in (first, second)
+    assert [record.name for record in section] == ["Python", "Go"]
+
+
+def test_skill_pagination():
+    '''
+    Page through all skills two at a time while deleting a record on the way
+
+    Check that every remaining skill is returned exactly once
+    '''
+    section = make_section(id_mode="positional")
+    for number in range(5):
+        section.append(Skill(f"Skill {number}", "1 Year", "example-logo.png"))
+
+    first_page, after = section.page(limit=2)
+    assert [record.name for record in first_page] == ["Skill 0", "Skill 1"]
+    section.delete(0)
+    second_page, after = section.page(after, limit=2)
+    assert [record.name for record in second_page] == ["Skill 2", "Skill 3"]
+    last_page, after = section.page(after, limit=2)
+    assert [record.name for record in last_page] == ["Skill 4"]
+    assert after is None
+
+    response = app.test_client().get('/resume/skill', query_string={'limit': 1})
+    assert len(response.json) == 1
+    cursor = response.headers['X-Next-Cursor']
+    response = app.test_client().get('/resume/skill',
+                                     query_string={'limit': 1, 'cursor': cursor})
+    assert response.json == app.test_client().get('/resume/skill').json[1:2]
+
+    response = app.test_client().get('/resume/skill', query_string={'cursor': 'nope'})
+    assert response.status_code == 400
+
+
+def test_experience_fields():
+    '''
+    Get all experiences with only some of their fields
+
+    Check that only the requested fields are returned
+    '''
+    response = app.test_client().get('/resume/experience',
+                                     query_string={'fields': 'title,company'})
+    assert response.json[0] == {"title": "Software Developer", "company": "A Cool Company"}
+
+    response = app.test_client().get('/resume/experience', query_string={'fields': 'salary'})
+    assert response.status_code == 400
+    assert "Unknown fields" in response.json['error']
+
+
+def test_json_cache():
+    '''
+    Get all skills twice, then add a skill and get them again
+
+    Check that the second read is a cache hit and the write invalidates it
+    '''
+    app.test_client().get('/resume/skill')
+    before = app.test_client().get('/cache/stats').json['skill']
+    first = app.test_client().get('/resume/skill')
+    after = app.test_client().get('/cache/stats').json['skill']
+    assert after['hits'] == before['hits'] + 1
+    assert after['misses'] == before['misses']
+
+    example_skill = {
+        "name": "Rust",
+        "proficiency": "1 Year",
+        "logo": "example-logo.png"
+    }
+    item_id = app.test_client().post('/resume/skill', json=example_skill).json['id']
+    second = app.test_client().get('/resume/skill')
+    assert second.json == first.json + [example_skill]
+    assert app.test_client().get(f'/resume/skill?index={item_id}').json == example_skill
+
+    updated_skill = {
+        "name": "Rust",
+        "proficiency": "2 Years",
+        "logo": "example-logo.png"
+    }
+    app.test_client().put(f'/resume/skill?index={item_id}', json=updated_skill)
+    assert app.test_client().get(f'/resume/skill?index={item_id}').json == updated_skill
+    assert app.test_client().get('/resume/skill').json[item_id] == updated_skill
+
+
+def test_conditional_get():
+    '''
+    Get all educations and one education again with the returned ETag
+
+    Check that 304 is returned until the education is changed
+    '''
+    response = app.test_client().get('/resume/education')
+    etag = response.headers['ETag']
+    assert response.headers['Last-Modified']
+    response = app.test_client().get('/resume/education', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+
+    record = app.test_client().get('/resume/education?index=0')
+    record_etag = record.headers['ETag']
+    response = app.test_client().get('/resume/education?index=0',
+                                     headers={'If-None-Match': record_etag})
+    assert response.status_code == 304
+
+    app.test_client().put('/resume/education?index=0', json=dict(record.json, grade="90%"))
+    response = app.test_client().get('/resume/education', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    response = app.test_client().get('/resume/education?index=0',
+                                     headers={'If-None-Match': record_etag})
+    assert response.status_code == 200
+    assert response.json['grade'] == "90%"
+
+
+def test_sqlite_shared_between_workers(tmp_path):
+    '''
+    Open the same SQLite database from two engines, like two worker processes
+
+    Check that writes from one are seen by the other and survive a restart
+    '''
+    path = str(tmp_path / "resume.db")
+    worker1 = SqliteEngine(path).section("skill")
+    worker2 = SqliteEngine(path).section("skill")
+
+    item_id = worker1.append(Skill("Python", "1-2 Years", "example-logo.png"))
+    assert worker2.get(item_id) == Skill("Python", "1-2 Years", "example-logo.png")
+
+    worker2.cache.collection(lambda: b"[]")
+    worker1.replace(item_id, Skill("Python", "3 Years", "example-logo.png"))
+    assert worker2.cache.collection(lambda: b"fresh")[0] == b"fresh"
+    assert worker2.get(item_id).proficiency == "3 Years"
+
+    worker1.engine.close()
+    worker2.engine.close()
+    restarted = SqliteEngine(path).section("skill")
+    assert list(restarted) == [Skill("Python", "3 Years", "example-logo.png")]
+    assert restarted.delete(item_id).name == "Python"
+    assert len(restarted) == 0
+    restarted.engine.close()
+
+
+def test_sqlite_seed_once(tmp_path):
+    '''
+    Load a SQLite database with seed records, delete them and load it again
+
+    Check that deleted seed records don't come back
+    '''
+    path = str(tmp_path / "resume.db")
+    seed = {"skill": [Skill("Seeded", "1-2 Years", "example-logo.png")]}
+    engine = SqliteEngine(path)
+    section = engine.load(seed)["skill"]
+    [(record_id, record)] = section.items()
+    assert record == seed["skill"][0]
+    assert engine.load(seed)["skill"].delete(record_id) == record
+    engine.close()
+    engine = SqliteEngine(path)
+    assert len(engine.load(seed)["skill"]) == 0
+    engine.close()
+
+
+def test_concurrent_writes():
+    '''
+    Post skills and partially update one experience from many threads at once
+
+    Check that no write is lost and every post got its own id
+    '''
+    threads_count = 8
+    posts_per_thread = 25
+    before = len(app.test_client().get('/resume/skill').json)
+    item_id = app.test_client().post('/resume/experience', json={
+        "title": "Software Developer",
+        "company": "A Cool Company",
+        "start_date": "October 2022",
+        "end_date": "Present",
+        "description": "Writing Python Code",
+        "logo": "example-logo.png"
+    }).json['id']
+    fields = ["title", "company", "start_date", "end_date", "description", "logo"]
+    ids = []
+
+    def worker(number):
+        client = app.test_client()
+        for post in range(posts_per_thread):
+            ids.append(client.post('/resume/skill', json={
+                "name": f"Skill {number}-{post}",
+                "proficiency": "1 Year",
+                "logo": "example-logo.png"
+            }).json['id'])
+            client.get('/resume/skill')
+        field = fields[number % len(fields)]
+        client.put(f'/resume/experience?index={item_id}', json={field: f"changed {field}"})
+
+    threads = [threading.Thread(target=worker, args=(number,)) for number in range(threads_count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    skills = app.test_client().get('/resume/skill').json
+    assert len(skills) == before + threads_count * posts_per_thread
+    assert len(skills) == len(data["skill"])
+    assert len(set(ids)) == threads_count * posts_per_thread
+    experience = app.test_client().get(f'/resume/experience?index={item_id}').json
+    assert all(experience[field] == f"changed {field}" for field in fields)
+
+
+def test_skill_bulk():
+    '''
+    Create, update and delete skills in one bulk request
+
+    Check that all of them are applied, that none are applied when one fails
+    and that updates without changes are not written
+    '''
+    before = app.test_client().get('/resume/skill').json
+    operations = [{"op": "create", "record": {
+        "name": f"Skill {number}",
+        "proficiency": "1 Year",
+        "logo": "example-logo.png"
+    }} for number in range(1000)]
+    response = app.test_client().post('/resume/skill/bulk', json=operations)
+    assert response.status_code == 200
+    ids = [result['id'] for result in response.json['results']]
+    assert ids == list(range(len(before), len(before) + 1000))
+
+    response = app.test_client().post('/resume/skill/bulk', json=[
+        {"op": "update", "index": ids[0], "record": {"proficiency": "2 Years"}},
+        {"op": "delete", "index": ids[-1]},
+    ])
+    assert response.json['results'][0]['record']['proficiency'] == "2 Years"
+    assert response.json['results'][1]['record']['name'] == "Skill 999"
+    skills = app.test_client().get('/resume/skill').json
+    assert len(skills) == len(before) + 999
+    assert skills[ids[0]]['proficiency'] == "2 Years"
+
+    # an update without changes writes nothing, and an update only drops the
+    # cached records it changed
+    version = data["skill"].version
+    last = app.test_client().get('/resume/changes').json["last"]
+    etag = app.test_client().get(f'/resume/skill?index={ids[1]}').headers["ETag"]
+    app.test_client().post('/resume/skill/bulk', json=[
+        {"op": "update", "index": ids[0], "record": {"proficiency": "2 Years"}}])
+    assert data["skill"].version == version
+    assert app.test_client().get('/resume/changes').json["last"] == last
+    app.test_client().post('/resume/skill/bulk', json=[
+        {"op": "update", "index": ids[0], "record": {"proficiency": "3 Years"}}])
+    assert app.test_client().get(f'/resume/skill?index={ids[1]}',
+                                 headers={"If-None-Match": etag}).status_code == 304
+    app.test_client().post('/resume/skill/bulk', json=[
+        {"op": "update", "index": ids[0], "record": {"proficiency": "2 Years"}}])
+
+    # ids shift after each delete of a batch, like deleting one at a time
+    section = make_section([Skill(name, "1 Year", "example-logo.png") for name in "abcdef"],
+                           id_mode="positional", name="skill")
+    section.apply([("delete", 1, None), ("delete", 1, None), ("create", None,
+                   Skill("g", "1 Year", "example-logo.png")), ("delete", 3, None)])
+    assert [skill.name for skill in section] == ["a", "d", "e", "g"]
+
+    response = app.test_client().post('/resume/skill/bulk', json=[
+        {"op": "delete", "index": ids[0]},
+        {"op": "delete", "index": 10 ** 6},
+    ])
+    assert response.status_code == 404
+    assert [result['status'] for result in response.json['results']] == [424, 404]
+    assert app.test_client().get('/resume/skill').json == skills
+
+    response = app.test_client().post('/resume/skill/bulk', json=[
+        {"op": "create", "record": {"name": "Go"}},
+        {"op": "rename", "index": 0},
+    ])
+    assert response.status_code == 400
+    assert "Missing fields" in response.json['results'][0]['error']
+    assert app.test_client().get('/resume/skill').json == skills
+
+
+@dataclass
+class Link:
+    '''
+    Nested model used to test the validators
+    '''
+    url: str
+    label: Optional[str] = None
+
+
+@dataclass
+class Project:
+    '''
+    Model with nested and optional fields used to test the validators
+    '''
+    name: str
+    stars: int
+    link: Link
+    tags: list[str] = dataclass_field(default_factory=list)
+
+
+def test_compiled_validator():
+    '''
+    Validate requests against a model with nested and optional fields
+
+    Check that the same errors as validate_request are returned
+    '''
+    validate = compile_validator(Project)
+    assert validate({"name": "API", "stars": 3, "link": {"url": "x"}}) == (0, "")
+    assert validate({"name": "API", "stars": 3, "link": {"url": "x"}, "tags": ["a"]}) == (0, "")
+    assert validate(["name"]) == (400, "Request data is not valid JSON")
+    assert validate({"name": "API"}) == (400, "Missing fields: stars, link")
+    assert validate({"name": "API", "stars": True, "link": {"url": "x"}})[0] == 400
+    assert validate({"name": "API", "stars": 3, "link": {"label": "x"}})[0] == 400
+    assert validate({"name": "API", "stars": 3, "link": {"url": "x"}, "tags": [1]})[0] == 400
+
+    validate_partial = compile_validator(Project, partial=True)
+    assert validate_partial({"stars": 4}) == (0, "")
+    assert validate_partial({"owner": "me"}) == (400, "Unknown fields: owner")
+
+    response = app.test_client().post('/resume/skill', json=["JavaScript"])
+    assert response.status_code == 400
+    assert response.json['error'] == "Request data is not valid JSON"
+
+
+def test_compact_records():
+    '''
+    Build two experiences from separately decoded strings
+
+    Check that they have no __dict__ and share their repeated values
+    '''
+    first = Experience("Engineer", "".join(["A Cool ", "Company"]), "October 2022",
+                       "".join(["Pre", "sent"]), "Code", "example-logo.png")
+    second = Experience("Lawyer", "".join(["A Cool ", "Comp", "any"]), "October 2020",
+                        "".join(["Pres", "ent"]), "Cases", "example-logo.png")
+    assert not hasattr(first, "__dict__")
+    assert first.company is second.company
+    assert first.end_date is second.end_date
+
+
+def test_ndjson_export_import():
+    '''
+    Import skills from NDJSON and export the whole resume
+
+    Check that valid lines are imported, invalid ones reported, and every
+    record is exported once
+    '''
+    before = len(data["skill"])
+    lines = [
+        {"section": "skill", "record": {"name": "C", "proficiency": "1 Year",
+                                        "logo": "example-logo.png"}},
+        {"section": "skill", "record": {"name": "C++"}},
+        {"section": "hobby", "record": {}},
+        {"section": "skill", "record": {"name": "Zig", "proficiency": "1 Year",
+                                        "logo": "example-logo.png"}},
+    ]
+    upload = "\n".join(json.dumps(line) for line in lines) + "\nnot json\n"
+    response = app.test_client().post('/resume/import', data=upload,
+                                      content_type='application/x-ndjson')
+    assert response.json['imported']['skill'] == 2
+    assert [error['line'] for error in response.json['errors']] == [2, 3, 5]
+    assert len(data["skill"]) == before + 2
+
+    response = app.test_client().get('/resume/export')
+    exported = [json.loads(line) for line in response.data.splitlines()]
+    assert len(exported) == sum(len(section) for section in data.values())
+    assert exported[-1] == lines[-1]
+
+
+def test_search_experience():
+    '''
+    Add experiences and search them by company, by words and sorted by title
+
+    Check that only the experiences with the words or values searched for are
+    returned, also after an update
+    '''
+    for title, company, description in [("Chef", "Search Co", "Cooking pasta dishes"),
+                                        ("Baker", "Search Co", "Baking bread"),
+                                        ("Waiter", "Other Co", "Serving pasta")]:
+        app.test_client().post('/resume/experience', json={
+            "title": title,
+            "company": company,
+            "start_date": "May 2020",
+            "end_date": "Present",
+            "description": description,
+            "logo": "example-logo.png"
+        })
+
+    response = app.test_client().get('/resume/experience',
+                                     query_string={'company': 'Search Co', 'fields': 'title'})
+    assert response.json == [{"title": "Chef"}, {"title": "Baker"}]
+    response = app.test_client().get('/resume/experience',
+                                     query_string={'q': 'PASTA', 'sort': '-title'})
+    assert [item['title'] for item in response.json] == ["Waiter", "Chef"]
+    response = app.test_client().get('/resume/experience',
+                                     query_string={'q': 'pasta', 'company': 'Search Co'})
+    assert [item['title'] for item in response.json] == ["Chef"]
+    # words match whole, with every storage engine
+    response = app.test_client().get('/resume/experience',
+                                     query_string={'q': 'past', 'company': 'Search Co'})
+    assert response.json == []
+
+    index = len(app.test_client().get('/resume/experience').json) - 3
+    app.test_client().put(f'/resume/experience?index={index}', json={"company": "Moved Co"})
+    response = app.test_client().get('/resume/experience', query_string={'company': 'Search Co'})
+    assert [item['title'] for item in response.json] == ["Baker"]
+
+    response = app.test_client().get('/resume/experience', query_string={'sort': 'salary'})
+    assert response.status_code == 400
+
+
+def test_education_dates():
+    '''
+    Add educations with free-form dates and query them by date
+
+    Check that they are filtered by start date and sorted chronologically
+    '''
+    assert parse_date("October 2022") < parse_date("2022-11") < parse_date("Present")
+    assert parse_date("Sep 2019") == parse_date("September 2019") == parse_date("2019-09")
+    assert parse_date("someday") is None
+
+    for course, start_date in [("Dates A", "March 2021"), ("Dates B", "2018-05"),
+                               ("Dates C", "Jan 2020"), ("Dates D", "someday")]:
+        app.test_client().post('/resume/education', json={
+            "course": course,
+            "school": "Date School",
+            "start_date": start_date,
+            "end_date": "Present",
+            "grade": "90%",
+            "logo": "example-logo.png"
+        })
+
+    response = app.test_client().get('/resume/education', query_string={
+        'school': 'Date School', 'sort': 'start_date', 'fields': 'course'})
+    assert [item['course'] for item in response.json] == ["Dates B", "Dates C",
+                                                          "Dates A", "Dates D"]
+    response = app.test_client().get('/resume/education', query_string={
+        'school': 'Date School', 'from': '2019-01', 'to': '2021-03', 'sort': '-start_date'})
+    assert [item['course'] for item in response.json] == ["Dates A", "Dates C"]
+
+    response = app.test_client().get('/resume/education', query_string={'from': 'soon'})
+    assert response.status_code == 400
+
+
+def test_logos(tmp_path, monkeypatch):
+    '''
+    Fetch a logo by its content hash
+
+    Check that it is served with long lived cache headers, that the hash
+    changes with the contents and that unknown hashes and sizes are rejected
+    '''
+    url = logo_store.url("example-logo.png")
+    assert url.startswith("/logos/")
+    response = app.test_client().get(url)
+    assert response.status_code == 200
+    assert response.mimetype == "image/png"
+    assert response.cache_control.immutable and response.cache_control.max_age == 31536000
+    response = app.test_client().get(url, headers={"If-None-Match": response.headers["ETag"]})
+    assert response.status_code == 304
+    assert app.test_client().get(url, query_string={"size": "64"}).status_code == 200
+    assert app.test_client().get(url, query_string={"size": "65"}).status_code == 400
+    assert app.test_client().get("/logos/unknown").status_code == 404
+
+    (tmp_path / "logo.png").write_bytes(b"first")
+    store = LogoStore(str(tmp_path), str(tmp_path / "thumbnails"))
+    first = store.logo_hash("logo.png")
+    (tmp_path / "logo.png").write_bytes(b"second!")
+    second = store.logo_hash("logo.png")
+    assert first != second
+    assert store.path(first) is None and store.path(second) == str(tmp_path / "logo.png")
+    assert store.logo_hash("../logo.png") is None
+    # the URL of contents that changed since is not served
+    with open(tmp_path / "logo.png", "ab") as logo:
+        logo.write(b" and more")
+    assert store.path(second) is None
+    # unknown hashes only make the directory be scanned when it changed
+    (tmp_path / "other.png").write_bytes(b"other")
+    scans = []
+    listdir = os.listdir
+    monkeypatch.setattr(os, "listdir", lambda path: scans.append(path) or listdir(path))
+    for _ in range(3):
+        assert store.path("garbage") is None
+    assert scans == [str(tmp_path)]
+
+    # only image files directly in the logo directory are ever served, other
+    # logos are kept and sent as they are
+    (tmp_path / "secret.txt").write_bytes(b"secret")
+    assert store.logo_hash("secret.txt") is None
+    for logo in ("app.py", ".git/config", "../logo.png", "https://cdn.example.com/acme.png"):
+        response = app.test_client().post('/resume/skill', json={
+            "name": "Rust", "proficiency": "1-2 Years", "logo": logo})
+        assert response.status_code == 200
+        assert logo_store.url(logo) == logo
+
+
+def test_compression():
+    '''
+    Get the experience collection with and without Accept-Encoding: gzip
+
+    Check that a large collection is compressed once and cached, and that
+    small bodies are sent as is
+    '''
+    long_experience = {
+        "title": "Compressed Developer",
+        "company": "Gzip Inc",
+        "start_date": "May 2020",
+        "end_date": "Present",
+        "description": "Writing a very long description " * 100,
+        "logo": "example-logo.png"
+    }
+    item_id = app.test_client().post('/resume/experience', json=long_experience).json["id"]
+    # the record is large enough to be compressed, which must not break PUT
+    response = app.test_client().put(f'/resume/experience?index={item_id}',
+                                     json={**long_experience, "company": "Brotli Inc"},
+                                     headers={"Accept-Encoding": "gzip"})
+    assert response.status_code == 200 and response.json["company"] == "Brotli Inc"
+    plain = app.test_client().get('/resume/experience')
+    assert plain.content_encoding is None and "Accept-Encoding" in plain.vary
+    response = app.test_client().get('/resume/experience',
+                                     headers={"Accept-Encoding": "gzip"})
+    assert response.content_encoding == "gzip"
+    assert len(response.data) < len(plain.data)
+    assert gzip.decompress(response.data) == plain.data
+    assert response.headers["ETag"] != plain.headers["ETag"]
+
+    entry = data["experience"].cache.collection(lambda: plain.data)
+    assert data["experience"].cache.compressed(entry, "gzip") is \
+        data["experience"].cache.compressed(entry, "gzip")
+
+    response = app.test_client().get('/resume/skill', query_string={'index': 0},
+                                     headers={"Accept-Encoding": "gzip"})
+    assert response.content_encoding is None
+
+
+def test_write_ahead_log(tmp_path):
+    '''
+    Write to sections with a write-ahead log, then recover them into new
+    sections from the log, from a snapshot, and from a log with a torn line
+
+    Check that the recovered sections match, for both id modes
+    '''
+    def skill(name):
+        return Skill(name, "1-2 Years", "example-logo.png")
+
+    for id_mode in ("positional", "stable"):
+        directory = str(tmp_path / id_mode)
+        wal = WriteAheadLog(directory, "always")
+        sections = wal.recover(make_data({"skill": [skill("Seed")]}, id_mode))
+        sections["skill"].append(skill("Go"))
+        sections["skill"].extend([skill("Rust"), skill("Zig")])
+        sections["skill"].replace(1, skill("Golang"))
+        sections["skill"].delete(0)
+        sections["skill"].apply([("create", None, skill("C")), ("delete", 2, None)])
+        expected = sections["skill"].items()
+        wal.close()
+
+        wal = WriteAheadLog(directory, "always")
+        sections = wal.recover(make_data({"skill": []}, id_mode))
+        assert sections["skill"].items() == expected
+        sections["skill"].append(skill("Java"))
+        wal.snapshot()
+        sections["skill"].delete(2)
+        expected = sections["skill"].items()
+        wal.close()
+        segment = sorted((tmp_path / id_mode).glob("log-*"))[-1]
+        segment.write_bytes(segment.read_bytes() + b'{"seq": 99, "sec')
+
+        wal = WriteAheadLog(directory, "always")
+        sections = wal.recover(make_data({"skill": []}, id_mode))
+        assert sections["skill"].items() == expected
+        wal.close()
+
+
+def test_write_ahead_log_snapshot_every(tmp_path):
+    '''
+    Write one skill at a time to a log that takes a snapshot every 5 writes
+
+    Check that the writes that trigger a snapshot don't hang waiting for the
+    log, and that the sections are recovered from the snapshots
+    '''
+    wal = WriteAheadLog(str(tmp_path), "always", snapshot_every=5)
+    sections = wal.recover(make_data({"skill": []}))
+
+    def writer():
+        for number in range(30):
+            sections["skill"].append(Skill(f"Skill {number}", "1-2 Years", "example-logo.png"))
+
+    thread = threading.Thread(target=writer, daemon=True)
+    thread.start()
+    thread.join(10)
+    assert not thread.is_alive()
+    expected = sections["skill"].items()
+    wal.close()
+
+    wal = WriteAheadLog(str(tmp_path), "always")
+    assert wal.recover(make_data({"skill": []}))["skill"].items() == expected
+    wal.close()
+
+
+def asgi_request(method, path, query_string=b"", json_body=None):
+    '''
+    Make a request to the ASGI application, the body arriving in two chunks.
+    Returns the status and the decoded JSON body
+    '''
+    body = b"" if json_body is None else json.dumps(json_body).encode()
+    messages = [{"type": "http.request", "body": body[:10], "more_body": True},
+                {"type": "http.request", "body": body[10:], "more_body": False}]
+    sent = []
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        # the client stays until it has the response
+        return await asyncio.Event().wait()
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "method": method, "path": path, "query_string": query_string,
+             "headers": [(b"content-type", b"application/json")], "http_version": "1.1"}
+    asyncio.run(application(scope, receive, send))
+    return sent[0]["status"], json.loads(b"".join(message.get("body", b"")
+                                                  for message in sent[1:]))
+
+
+def test_asgi():
+    '''
+    Add a skill through the ASGI application and read it back through both
+    applications
+
+    Check that both see the same data
+    '''
+    assert asgi_request("GET", "/test") == (200, {"message": "Hello, World!"})
+    example_skill = {
+        "name": "Async Python",
+        "proficiency": "2-4 Years",
+        "logo": "example-logo.png"
+    }
+    status, body = asgi_request("POST", "/resume/skill", json_body=example_skill)
+    assert status == 200
+    query_string = f"index={body['id']}".encode()
+    assert asgi_request("GET", "/resume/skill", query_string) == (200, example_skill)
+    assert app.test_client().get('/resume/skill', query_string={'index': body['id']}).json \
+        == example_skill
+    assert asgi_request("POST", "/resume/skill", json_body={"name": "Async"})[0] == 400
+
+
+def test_asgi_disconnect():
+    '''
+    Open the event stream through the ASGI application and disconnect
+
+    Check that the application returns once the stream has something to
+    send, instead of streaming to nobody
+    '''
+    connected = asyncio.Event()
+
+    async def receive():
+        if not connected.is_set():
+            connected.set()
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await asyncio.sleep(0.1)
+        return {"type": "http.disconnect"}
+
+    async def send(_message):
+        pass
+
+    def add_skill():
+        stream_open.wait(10)
+        app.test_client().post('/resume/skill', json={
+            "name": "Disconnect", "proficiency": "1-2 Years", "logo": "example-logo.png"})
+
+    scope = {"type": "http", "method": "GET", "path": "/resume/changes", "query_string": b"",
+             "headers": [(b"accept", b"text/event-stream")], "http_version": "1.1"}
+    stream_open = threading.Event()
+    thread = threading.Thread(target=add_skill, daemon=True)
+    thread.start()
+
+    async def run():
+        stream = asyncio.create_task(application(scope, receive, send))
+        await asyncio.sleep(0.3)
+        stream_open.set()
+        await asyncio.wait_for(stream, 10)
+
+    asyncio.run(run())
+    thread.join(10)
+
+
+def test_asgi_stream_thread(monkeypatch):
+    '''
+    Open the event stream through the ASGI application with a single
+    handler thread, then make a request and a change while it waits
+
+    Check that the request is answered and the stream sends the change, as
+    a waiting stream doesn't hold the thread
+    '''
+    monkeypatch.setattr(asgi, "executor", ThreadPoolExecutor(1))
+    last = app.test_client().get('/resume/changes').json["last"]
+    sent = []
+    requests = [{"type": "http.request", "body": b"", "more_body": False}]
+    gone = asyncio.Event()
+
+    async def receive():
+        if requests:
+            return requests.pop()
+        await gone.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+        if b"event: create" in message.get("body", b""):
+            gone.set()
+
+    scope = {"type": "http", "method": "GET", "path": "/resume/changes", "query_string": b"",
+             "headers": [(b"accept", b"text/event-stream")], "http_version": "1.1"}
+
+    async def other(_message):
+        pass
+
+    async def run():
+        stream = asyncio.create_task(application(scope, receive, send))
+        await asyncio.sleep(0.2)
+        requests.append({"type": "http.request", "body": b"", "more_body": False})
+        test_scope = {**scope, "path": "/test", "headers": []}
+        await asyncio.wait_for(application(test_scope, receive, other), 5)
+        await asyncio.get_running_loop().run_in_executor(None, lambda: app.test_client().post(
+            '/resume/skill', json={"name": "Streamed", "proficiency": "1-2 Years",
+                                   "logo": "example-logo.png"}))
+        await asyncio.wait_for(stream, 5)
+
+    asyncio.run(run())
+    assert f"id: {last + 1}\nevent: create\n".encode() in sent[-1]["body"]
+
+
+def test_metrics():
+    '''
+    Make a few requests and read /metrics
+
+    Check that requests, errors, stages and sizes are counted per route
+    '''
+    app.test_client().get('/resume/skill')
+    app.test_client().post('/resume/skill', json={"name": "Metrics"})
+    text = app.test_client().get('/metrics').get_data(as_text=True)
+    assert '# TYPE resume_request_duration_seconds histogram' in text
+    assert 'resume_requests_total{route="/resume/skill",method="GET",status="200"}' in text
+    assert 'resume_request_errors_total{route="/resume/skill",method="POST",status="400"}' \
+        in text
+    for stage in ("routing", "parse", "validate", "lookup", "serialize"):
+        assert f'resume_stage_duration_seconds_count{{stage="{stage}"}}' in text
+    assert 'resume_request_size_bytes_bucket{route="/resume/skill",le="+Inf"}' in text
+
+
+def test_sampling_profiler():
+    '''
+    Profile a thread that keeps calling one function
+
+    Check that the function shows up in the hot stacks
+    '''
+    done = threading.Event()
+
+    def busy_loop():
+        while not done.is_set():
+            sum(range(1000))
+
+    thread = threading.Thread(target=busy_loop)
+    thread.start()
+    profiler = SamplingProfiler(thread.ident, interval=0.001).start()
+    while sum(profiler.samples.values()) < 5:
+        done.wait(0.01)
+    profiler.stop()
+    done.set()
+    thread.join()
+    assert "busy_loop" in profiler.hot_stacks()
+
+
+def test_positional_tombstones():
+    '''
+    Delete, update and add skills at random positions of a positional section,
+    doing the same on a plain list
+
+    Check that positions keep matching the list through compactions
+    '''
+    rng = random.Random(19)
+    expected = [Skill(f"Skill {number}", "1-2 Years", "example-logo.png")
+                for number in range(300)]
+    section = make_section(expected, "positional", "skill")
+    for step in range(1000):
+        position = rng.randrange(len(expected))
+        if step % 3 == 0:
+            assert section.delete(position) == expected.pop(position)
+        elif step % 3 == 1:
+            updated = Skill(f"Updated {step}", "1-2 Years", "example-logo.png")
+            section.replace(position, updated)
+            expected[position] = updated
+        else:
+            new = Skill(f"New {step}", "1-2 Years", "example-logo.png")
+            assert section.append(new) == len(expected)
+            expected.append(new)
+        assert len(section) == len(expected)
+        assert section.get(position) == (expected[position] if position < len(expected)
+                                         else None)
+    assert list(section) == expected
+    assert section.page(None, 50)[0] == expected[:50]
+    assert section.search({"name": expected[-1].name}) == [expected[-1]]
+
+
+def test_patch():
+    '''
+    Patch a skill with a JSON Merge Patch, then patch it again with the same
+    values
+
+    Check that only the changed field is updated and that a patch without
+    changes doesn't invalidate the cached skill
+    '''
+    item_id = app.test_client().post('/resume/skill', json={
+        "name": "Patchable",
+        "proficiency": "1-2 Years",
+        "logo": "example-logo.png"
+    }).json['id']
+    response = app.test_client().patch(f'/resume/skill?index={item_id}',
+                                       json={"proficiency": "2-4 Years"},
+                                       content_type="application/merge-patch+json")
+    assert response.json == {"name": "Patchable", "proficiency": "2-4 Years",
+                             "logo": "example-logo.png"}
+
+    etag = app.test_client().get(f'/resume/skill?index={item_id}').headers["ETag"]
+    version = data["skill"].version
+    app.test_client().patch(f'/resume/skill?index={item_id}', json={"name": "Patchable"})
+    assert data["skill"].version == version
+    response = app.test_client().get(f'/resume/skill?index={item_id}',
+                                     headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+    assert app.test_client().patch(f'/resume/skill?index={item_id}',
+                                   json={"name": None}).status_code == 400
+    assert app.test_client().patch(f'/resume/skill?index={item_id}',
+                                   json={"level": "high"}).status_code == 400
+    assert app.test_client().patch('/resume/education?index=999',
+                                   json={"grade": "90%"}).status_code == 404
+
+
+def test_users(monkeypatch):
+    '''
+    Add skills to the resumes of two users
+
+    Check that every user only sees their own skills, that users without a
+    resume see empty sections, that only writes adding records add users
+    and that the memory of a user is reported
+    '''
+    # users are kept in memory whatever storage the suite runs with
+    monkeypatch.setattr("app.DEFAULT_STORAGE", "memory")
+    for user_id, name in (("alice", "Rust"), ("bob", "Haskell")):
+        response = app.test_client().post(f'/users/{user_id}/resume/skill', json={
+            "name": name,
+            "proficiency": "1-2 Years",
+            "logo": "example-logo.png"
+        })
+        assert response.json == {"id": 0}
+    assert [skill["name"] for skill in app.test_client().get('/users/alice/resume/skill').json] \
+        == ["Rust"]
+    assert app.test_client().get('/users/bob/resume/skill?index=0').json["name"] == "Haskell"
+    assert app.test_client().get('/users/nobody/resume/experience').json == []
+    assert tenants.get("nobody") is tenants.empty
+    assert tenants.get("alice") is not tenants.get("bob")
+    assert all(skill["name"] != "Haskell" for skill in app.test_client().get('/resume/skill').json)
+
+    usage = app.test_client().get('/users/alice/memory').json
+    assert usage["records"] == 1 and usage["bytes"] > 0
+    assert app.test_client().get('/users/nobody/memory').json == {"records": 0, "bytes": 0}
+
+    # writes that fail or add nothing don't add the user
+    app.test_client().delete('/users/nobody/resume/education?index=0')
+    app.test_client().put('/users/nobody/resume/skill?index=0', json={
+        "name": "Rust", "proficiency": "1-2 Years", "logo": "example-logo.png"})
+    app.test_client().post('/users/nobody/resume/skill/bulk', json=[
+        {"op": "create", "record": {"name": "Rust", "proficiency": "1-2 Years",
+                                    "logo": "example-logo.png"}},
+        {"op": "delete", "index": 5}])
+    app.test_client().post('/users/nobody/resume/import', data=b"")
+    assert tenants.get("nobody") is tenants.empty
+    app.test_client().post('/users/nobody/resume/skill/bulk', json=[
+        {"op": "create", "record": {"name": "Rust", "proficiency": "1-2 Years",
+                                    "logo": "example-logo.png"}}])
+    assert len(tenants.get("nobody")["skill"]) == 1
+
+    monkeypatch.setattr("app.DEFAULT_STORAGE", "sqlite")
+    assert app.test_client().get('/users/alice/resume/skill').status_code == 501
+
+
+def test_resume(monkeypatch):
+    '''
+    Get the whole resume in one request and check that it matches the
+    sections, that sections= selects some of them and that its ETag changes
+    when a section does
+    '''
+    monkeypatch.setattr("app.DEFAULT_STORAGE", "memory")
+    response = app.test_client().get('/resume')
+    assert response.status_code == 200
+    assert response.json == {name: app.test_client().get(f'/resume/{name}').json
+                             for name in ("experience", "education", "skill")}
+    etag = response.headers["ETag"]
+    assert app.test_client().get('/resume', headers={"If-None-Match": etag}).status_code == 304
+
+    response = app.test_client().get('/resume?sections=skill,education')
+    assert list(response.json) == ["skill", "education"]
+    assert app.test_client().get('/resume?sections=skill,hobbies').status_code == 400
+    assert app.test_client().get('/users/somebody/resume').json == {
+        "experience": [], "education": [], "skill": []}
+
+    app.test_client().post('/resume/skill', json={
+        "name": "Go",
+        "proficiency": "1-2 Years",
+        "logo": "example-logo.png"
+    })
+    response = app.test_client().get('/resume', headers={"If-None-Match": etag})
+    assert response.status_code == 200 and response.headers["ETag"] != etag
+    assert response.json["skill"][-1]["name"] == "Go"
+
+
+def test_json_provider(monkeypatch):
+    '''
+    Encode records with the JSON provider, with orjson if it is installed and
+    with the json module, and check that both give the same JSON
+    '''
+    now = datetime(2024, 5, 1, tzinfo=timezone.utc)
+    value = {"skills": list(data["skill"]), "experience": data["experience"].get(0),
+             "checked": now}
+    with app.app_context():
+        encoded = app.json.dumps(value)
+        compact = app.json.response(value).get_data()
+        monkeypatch.setattr(serialization, "orjson", None)
+        assert json.loads(encoded) == json.loads(app.json.dumps(value))
+        assert json.loads(compact) == json.loads(app.json.response(value).get_data())
+    assert json.loads(encoded)["checked"] == "Wed, 01 May 2024 00:00:00 GMT"
+    assert json.loads(encoded)["experience"] == serialization.record_to_dict(
+        data["experience"].get(0))
+    assert serialization.record_to_dict(Skill("Rust", "1-2 Years", "logo.png")) == {
+        "name": "Rust", "proficiency": "1-2 Years", "logo": "logo.png"}
+
+
+def test_rate_limit(monkeypatch):
+    '''
+    Give writes a budget of two requests and check that the third write of a
+    client is refused with 429 while its reads go through, then fill the
+    only request slot and check that a request is refused with 503
+    '''
+    monkeypatch.setattr(admission, "budgets", {"read": None, "write": (0.001, 2)})
+    admission.buckets.reset()
+    skill = {"name": "Zig", "proficiency": "1-2 Years", "logo": "example-logo.png"}
+    for _ in range(2):
+        assert app.test_client().post('/resume/skill', json=skill).status_code == 200
+    response = app.test_client().post('/resume/skill', json=skill)
+    assert response.status_code == 429 and int(response.headers["Retry-After"]) >= 1
+    assert app.test_client().get('/resume/skill').status_code == 200
+    admission.buckets.reset()
+
+    monkeypatch.setattr(admission, "slots", threading.BoundedSemaphore(1))
+    monkeypatch.setattr(admission, "queue_timeout", 0.01)
+    assert admission.enter()
+    response = app.test_client().get('/resume/skill')
+    assert response.status_code == 503 and response.headers["Retry-After"] == "1"
+    admission.leave()
+    assert app.test_client().get('/resume/skill').status_code == 200
+    assert admission.enter()
+    admission.leave()
+
+
+def test_shared_token_buckets():
+    '''
+    Check that two tables opened with the same name share their buckets,
+    and that the buckets stay after another process using them exits
+    '''
+    name = f"resume-ratelimit-test-{random.randrange(1 << 30)}"
+    first = SharedTokenBuckets(name, slots=16)
+    second = SharedTokenBuckets(name, slots=16)
+    try:
+        assert first.take("client", 0.001, 1) == 0
+        assert second.take("client", 0.001, 1) > 0
+        assert second.take("other", 0.001, 1) == 0
+        subprocess.run([sys.executable, "-c", "import sys, ratelimit; ratelimit.SharedTokenBuckets("
+                        "sys.argv[1], slots=16).take('worker', 0.001, 1)", name],
+                       check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        assert first.take("worker", 0.001, 1) > 0
+    finally:
+        second.close()
+        first.close(unlink=True)
+
+
+def test_changes(monkeypatch):
+    '''
+    Make some changes and check that they can be caught up with ?since=, in
+    order, and that the event stream sends them too
+    '''
+    last = app.test_client().get('/resume/changes').json["last"]
+    skill = {"name": "Elixir", "proficiency": "1-2 Years", "logo": "example-logo.png"}
+    skill_id = app.test_client().post('/resume/skill', json=skill).json["id"]
+    app.test_client().put(f'/resume/skill?index={skill_id}', json={**skill, "name": "Erlang"})
+    # an identical record is not a change
+    app.test_client().put(f'/resume/skill?index={skill_id}', json={**skill, "name": "Erlang"})
+    education_id = app.test_client().post('/resume/education', json={
+        "course": "Distributed Systems",
+        "school": "University of Stuttgart",
+        "start_date": "October 2022",
+        "end_date": "Present",
+        "grade": "80%",
+        "logo": "example-logo.png"
+    }).json["id"]
+    app.test_client().delete(f'/resume/education?index={education_id}')
+
+    response = app.test_client().get(f'/resume/changes?since={last}')
+    events = response.json["events"]
+    assert response.json["last"] == last + 4
+    assert [event["seq"] for event in events] == list(range(last + 1, last + 5))
+    assert [(event["section"], event["type"], event["id"]) for event in events] == [
+        ("skill", "create", skill_id), ("skill", "update", skill_id),
+        ("education", "create", education_id), ("education", "delete", education_id)]
+    assert events[1]["record"]["name"] == "Erlang" and events[3]["record"] is None
+    assert app.test_client().get('/resume/changes?since=x').status_code == 400
+    assert app.test_client().get(f'/resume/changes?since={last + 5}').status_code == 410
+
+    response = app.test_client().get(f'/resume/changes?since={last + 2}',
+                                     headers={"Accept": "text/event-stream"})
+    assert response.mimetype == "text/event-stream"
+    chunk = next(iter(response.response)).decode()
+    response.close()
+    assert chunk.startswith(f"id: {last + 3}\nevent: create\ndata: ")
+    assert f"id: {last + 4}\nevent: delete\n" in chunk
+
+    feed = ChangeFeed(2)
+    for number in range(3):
+        feed.publish("skill", "delete", number)
+    assert feed.since(0) is None and [event["id"] for event in feed.since(1)] == [1, 2]
+    # without since there is nothing to catch up with, even once the ring is full
+    response = app.test_client().get('/resume/changes')
+    assert response.status_code == 200 and response.json["events"] == []
+
+    # reading the changes of a user without a resume creates nothing
+    monkeypatch.setattr("app.DEFAULT_STORAGE", "memory")
+    assert app.test_client().get('/users/nobody-yet/resume/changes').json == {
+        "last": 0, "events": []}
+    assert feed_of(tenants.resume("nobody-yet")) is None
+
+
+def test_changes_order():
+    '''
+    Update, delete and add skills from several threads at once, with
+    positional ids
+
+    Check that applying the changes in the order of their numbers to the
+    starting records gives the records of the section
+    '''
+    start = [Skill(f"Skill {number}", "1-2 Years", "example-logo.png") for number in range(50)]
+    section = make_section(start, "positional", "skill")
+    feed = attach({"skill": section})
+
+    def writer(seed):
+        chooser = random.Random(seed)
+        for number in range(200):
+            index = chooser.randrange(max(1, len(section)))
+            action = chooser.choice(("update", "delete", "create"))
+            if action == "update":
+                section.replace(index, Skill(f"Skill {seed}-{number}", "3 Years",
+                                             "example-logo.png"))
+            elif action == "delete":
+                section.delete(index)
+            else:
+                section.append(Skill(f"New {seed}-{number}", "1 Year", "example-logo.png"))
+
+    threads = [threading.Thread(target=writer, args=(seed,)) for seed in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    replayed = list(start)
+    events = feed.since(0)
+    assert events is not None and [event["seq"] for event in events] == \
+        list(range(1, feed.last + 1))
+    for event in events:
+        if event["type"] == "create":
+            assert event["id"] == len(replayed)
+            replayed.append(event["record"])
+        elif event["type"] == "update":
+            replayed[event["id"]] = event["record"]
+        else:
+            del replayed[event["id"]]
+    assert replayed == list(section)
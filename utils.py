@@ -2,140 +2,466 @@
 Utils file which separates the logic from the app.py router file
 '''
 
+import base64
+import binascii
 import dataclasses
-from flask import jsonify
-from models import Experience
+import hashlib
+import json
+from operator import attrgetter
+from datetime import datetime, timezone
+from flask import current_app, jsonify, request
+from compress import COMPRESSORS, choose_encoding
+from indexes import DATE_FIELDS, EXACT_FIELDS, parse_date
+from metrics import timed
+from models import Experience, SECTION_MODELS
+from serialization import record_to_dict
+from validation import VALIDATORS, PARTIAL_VALIDATORS
 
+MAX_PAGE_SIZE = 1000
+EXPORT_PAGE_SIZE = 500
+IMPORT_BATCH_SIZE = 1000
+MAX_IMPORT_ERRORS = 100
+BULK_OPERATIONS = ("create", "update", "delete")
+EXPERIENCE_FIELDS = tuple(field.name for field in dataclasses.fields(Experience))
+
+def encode_json(obj):
+    '''
+    Encode an object the same way jsonify does and return the bytes
+    '''
+    return f"{current_app.json.dumps(obj)}\n".encode()
+
+def json_response(body):
+    '''
+    Wrap already encoded JSON bytes in a response
+    '''
+    return current_app.response_class(body, mimetype=current_app.json.mimetype)
+
+def conditional_json_response(section, entry):
+    '''
+    Wrap a cached (bytes, etag) entry of a section in a response with ETag and
+    Last-Modified headers. Answers 304 Not Modified when the request carries a
+    matching If-None-Match or If-Modified-Since header. Large bodies are
+    compressed when the client accepts it, the compressed bytes are cached too
+    '''
+    return _conditional_response(entry, section.last_modified, section.cache.compressed)
+
+def _conditional_response(entry, last_modified, compress):
+    body, etag = entry
+    encoding = choose_encoding(request.accept_encodings, len(body))
+    if encoding is not None:
+        body = compress(entry, encoding)
+        # each encoding is a different representation with its own ETag
+        etag = f"{etag}-{encoding}"
+    response = json_response(body)
+    response.vary.add("Accept-Encoding")
+    if encoding is not None:
+        response.content_encoding = encoding
+    response.set_etag(etag)
+    response.last_modified = datetime.fromtimestamp(last_modified, timezone.utc)
+    return response.make_conditional(request)
+
+def get_section_json(section):
+    '''
+    Return the (bytes, etag) of the records of a section, served from its cache
+    '''
+    return section.cache.collection(lambda: encode_json(list(section)))
+
+def get_record_json(section, index):
+    '''
+    Return the (bytes, etag) of the record with the given id, served from the
+    section cache, or None if not found
+    '''
+    key = section.key_of(index)
+    if key is None:
+        return None
+    return section.cache.record(key, lambda: encode_json(section.get(index)))
+
+@timed("lookup")
+def get_resume(data, sections=None):
+    '''
+    Return every section of the resume in one JSON object, or only those named
+    in the comma separated sections. The object is put together from the
+    cached JSON of each section, nothing is encoded again, and its ETag is
+    made from the ETags of the sections
+    '''
+    names = list(SECTION_MODELS) if sections is None else sections.split(",")
+    unknown = [name for name in names if name not in SECTION_MODELS]
+    if unknown:
+        return jsonify({"error": f"Unknown sections: {', '.join(unknown)}"}), 400
+    names = list(dict.fromkeys(names))
+    entries = [get_section_json(data[name]) for name in names]
+    # the cached bytes end with a newline, like jsonify's
+    body = b"{" + b",".join(b'"%s":%s' % (name.encode(), fragment[:-1])
+                            for name, (fragment, _) in zip(names, entries)) + b"}\n"
+    etag = hashlib.md5("".join(etag for _, etag in entries).encode(),
+                       usedforsecurity=False).hexdigest()
+    # the combined bytes are not cached, so neither is their compressed copy
+    return _conditional_response((body, etag),
+                                 max(data[name].last_modified for name in names),
+                                 lambda entry, encoding: COMPRESSORS[encoding](entry[0]))
+
+@timed("lookup")
 def get_experience_by_index(data, index):
     '''
     Return specific experience by index or None if not found
     '''
-    index = int(index)
-    if 0 <= index < len(data["experience"]):
-        exp = data["experience"][index]
-        return jsonify({"title": exp.title,
-                        "company": exp.company,
-                        "start_date": exp.start_date,
-                        "end_date": exp.end_date,
-                        "description": exp.description,
-                        "logo": exp.logo,
-                        })
+    entry = get_record_json(data["experience"], index)
+    if entry is not None:
+        return conditional_json_response(data["experience"], entry)
     return jsonify({"Server Error": "Couldn't find needed experience"})
 
+@timed("lookup")
 def get_education_by_index(data, index):
     '''
     Return specific education by index or None if not found
     '''
-    index = int(index)
-    if 0 <= index < len(data["education"]):
-        edu = data["education"][index]
-        return jsonify({"course": edu.course,
-                        "school": edu.school,
-                        "start_date": edu.start_date,
-                        "end_date": edu.end_date,
-                        "grade": edu.grade,
-                        "logo": edu.logo,
-                        })
+    entry = get_record_json(data["education"], index)
+    if entry is not None:
+        return conditional_json_response(data["education"], entry)
     return jsonify({"Server Error": "Couldn't find needed education"})
 
+@timed("lookup")
 def get_skill_by_index(data, index):
     '''
     Return specific skill by index or None if not found
     '''
-    index = int(index)
-    if 0 <= index < len(data["skill"]):
-        target_skill = data["skill"][index]
-        return jsonify({"name": target_skill.name,
-                        "proficiency": target_skill.proficiency,
-                        "logo": target_skill.logo,
-                        })
+    entry = get_record_json(data["skill"], index)
+    if entry is not None:
+        return conditional_json_response(data["skill"], entry)
     return jsonify({"Server Error": "Couldn't find needed skill"})
 
+def encode_cursor(key):
+    '''
+    Turn a record key into an opaque cursor string
+    '''
+    return base64.urlsafe_b64encode(str(key).encode()).decode()
 
-def validate_request(req, required_fields):
+def decode_cursor(cursor):
+    '''
+    Turn a cursor string back into a record key or None if it is invalid
+    '''
+    try:
+        return int(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (binascii.Error, UnicodeError, ValueError):
+        return None
+
+def parse_fields(section, fields):
+    '''
+    Parse a fields= projection. Returns an error message or None, and the
+    names of the fields to return
+    '''
+    names = [field.name for field in dataclasses.fields(SECTION_MODELS[section])]
+    if fields is None:
+        return None, names
+    requested = [name.strip() for name in fields.split(",") if name.strip()]
+    unknown = [name for name in requested if name not in names]
+    if unknown:
+        return f"Unknown fields: {', '.join(unknown)}", None
+    return None, requested
+
+def parse_limit(limit):
+    '''
+    Parse a limit= value. Returns an error message or None, and the limit
+    '''
+    if limit is None:
+        return None, None
+    if not limit.isdigit() or int(limit) == 0:
+        return "limit must be a positive integer", None
+    return None, min(int(limit), MAX_PAGE_SIZE)
+
+def search_records(data, section, args):
+    '''
+    Return the records of a section matching the field=value filters, the q=
+    query and the from=/to= range of start_date (like 2019-01), sorted by the
+    sort= field (prefix it with - for descending order). Dates are sorted
+    chronologically. Returns an error message or None, and the records
+    '''
+    filters = {name: args[name] for name in EXACT_FIELDS[section] if name in args}
+    sort = args.get("sort")
+    date_range = None
+    if "from" in args or "to" in args:
+        low, high = (None if args.get(name) is None else parse_date(args[name])
+                     for name in ("from", "to"))
+        if "start_date" not in DATE_FIELDS[section]:
+            return f"{section} has no dates", None
+        if (low is None and "from" in args) or (high is None and "to" in args):
+            return "Dates must look like 2019-01 or October 2019", None
+        date_range = ("start_date", low, high)
+
+    date_sort = None
+    if sort is not None:
+        name = sort.removeprefix("-")
+        if name not in (field.name for field in dataclasses.fields(SECTION_MODELS[section])):
+            return f"Unknown sort field: {name}", None
+        if name in DATE_FIELDS[section]:
+            date_sort = (name, sort.startswith("-"))
+
+    records = data[section].search(filters, args.get("q"), date_range, date_sort)
+    if sort is not None and date_sort is None:
+        records.sort(key=attrgetter(sort.removeprefix("-")), reverse=sort.startswith("-"))
+    return None, records
+
+@timed("lookup")
+def get_section_page(data, section, args):
     '''
-    Returns an error code and message if the request is invalid
+    Return the records of a section as a JSON list.
+    - limit/cursor select a page, the cursor for the next page is sent in the
+      X-Next-Cursor header
+    - field=value (for the indexed fields), q=, from=/to= and sort= search
+      the section
+    - fields= picks which fields of each record are returned
     '''
-    missing_fields = [field for field in list(required_fields.keys()) if field not in req]
+    cursor = args.get("cursor")
+    searching = not args.keys().isdisjoint((*EXACT_FIELDS[section], "q", "sort", "from", "to"))
+    if not searching and cursor is None and not {"fields", "limit"} & args.keys():
+        return conditional_json_response(data[section], get_section_json(data[section]))
 
+    records, next_after = [], None
+    err_message, names = parse_fields(section, args.get("fields"))
+    limit_error, limit = parse_limit(args.get("limit"))
+    err_message = err_message or limit_error
+    if err_message is None and searching:
+        if cursor is not None:
+            err_message = "cursor can't be combined with search or sort"
+        else:
+            err_message, records = search_records(data, section, args)
+            records = (records or [])[:limit]
+    elif err_message is None:
+        after = None if cursor is None else decode_cursor(cursor)
+        if cursor is not None and after is None:
+            err_message = "Invalid cursor"
+        else:
+            records, next_after = data[section].page(after, limit)
+    if err_message is not None:
+        return jsonify({"error": err_message}), 400
+
+    records = map(record_to_dict, records)
+    response = jsonify([{name: fields[name] for name in names} for fields in records])
+    if next_after is not None:
+        response.headers["X-Next-Cursor"] = encode_cursor(next_after)
+    return response
+
+def apply_changes(record, changes):
+    '''
+    Return a copy of record with the changed fields, or record itself if no
+    field actually changes, in which case the section writes nothing
+    '''
+    diff = {name: value for name, value in changes.items() if getattr(record, name) != value}
+    return dataclasses.replace(record, **diff) if diff else record
+
+@timed("lookup")
+def patch_record(data, section, index, patch):
+    '''
+    Apply a JSON Merge Patch (RFC 7396) to the record with the given id and
+    return the patched record. Records are flat and every field is required,
+    so fields can be changed but not removed with null
+    '''
+    if not isinstance(patch, dict):
+        return jsonify({"error": "Request data is not valid JSON"}), 400
+    removed = [name for name, value in patch.items() if value is None]
+    if removed:
+        return jsonify({"error": f"Fields can't be removed: {', '.join(removed)}"}), 400
+    code, err_message = PARTIAL_VALIDATORS[section](patch)
+    if code != 0:
+        return jsonify({"error": err_message}), code
+    updated = data[section].update(index, lambda existing: apply_changes(existing, patch))
+    if updated is None:
+        return jsonify({"Server Error": f"Couldn't find needed {section}"}), 404
+    return jsonify(updated)
+
+def build_record(section, req):
+    '''
+    Build the record of a section from a validated request body
+    '''
+    model = SECTION_MODELS[section]
+    return model(**{field.name: req[field.name]
+                    for field in dataclasses.fields(model) if field.name in req})
+
+def parse_bulk_operation(operation, section):
+    '''
+    Check one operation of a bulk request. Returns an error message, or None
+    and the (kind, index, value) tuple to pass to the section
+    '''
+    if not isinstance(operation, dict) or operation.get("op") not in BULK_OPERATIONS:
+        return f"op must be one of {', '.join(BULK_OPERATIONS)}", None
+    kind = operation["op"]
+    record = operation.get("record", {})
+    if not isinstance(record, dict):
+        return "Request data is not valid JSON", None
+
+    if kind == "create":
+        code, err_message = VALIDATORS[section](record)
+        parsed = None if code != 0 else (kind, None, build_record(section, record))
+        return err_message or None, parsed
+
+    index = operation.get("index")
+    if not isinstance(index, int):
+        return "index must be an integer", None
+    if kind == "delete":
+        return None, (kind, index, None)
+    code, err_message = PARTIAL_VALIDATORS[section](record)
+    parsed = None if code != 0 else \
+        (kind, index, lambda existing: apply_changes(existing, record))
+    return err_message or None, parsed
+
+@timed("lookup")
+def apply_bulk(data, section, operations):
+    '''
+    Validate every operation of a bulk request in one pass and then apply them
+    all at once. Returns a result for each operation; if any operation is
+    invalid or targets a missing record nothing is applied
+    '''
+    if not isinstance(operations, list):
+        return jsonify({"error": "Request data must be a list of operations"}), 400
+
+    parsed = []
+    errors = {}
+    for position, operation in enumerate(operations):
+        err_message, parsed_operation = parse_bulk_operation(operation, section)
+        if err_message is not None:
+            errors[position] = err_message
+        parsed.append(parsed_operation)
+    if errors:
+        return jsonify({"results": [
+            {"status": 400, "error": errors[position]} if position in errors
+            else {"status": 424, "error": "Not applied"}
+            for position in range(len(operations))
+        ]}), 400
+
+    results = data[section].apply(parsed)
+    if results and results[-1] is None:
+        failed = len(results) - 1
+        return jsonify({"results": [
+            {"status": 404, "error": f"Couldn't find needed {section}"} if position == failed
+            else {"status": 424, "error": "Not applied"}
+            for position in range(len(operations))
+        ]}), 404
+
+    return jsonify({"results": [
+        {"status": 200, "id": result} if kind == "create" else {"status": 200, "record": result}
+        for (kind, _, _), result in zip(parsed, results)
+    ]})
+
+def export_ndjson(data):
+    '''
+    Yield every record of every section as one line of NDJSON like
+    {"section": "skill", "record": {...}}. Sections are read a page at a time
+    so memory use doesn't grow with the size of the resume
+    '''
+    for section_name, section in data.items():
+        after = None
+        while True:
+            records, after = section.page(after, EXPORT_PAGE_SIZE)
+            yield b"".join(encode_json({"section": section_name,
+                                        "record": record_to_dict(record, public=False)})
+                           for record in records)
+            if after is None:
+                break
+
+def import_ndjson(data, stream):
+    '''
+    Read NDJSON lines like the ones of export_ndjson from a stream and add the
+    records to their sections. Lines are validated with the same rules as the
+    POST handlers, invalid lines are skipped and reported. Records are added
+    in batches so only one batch is held in memory at a time
+    '''
+    batches = {section: [] for section in data}
+    imported = {section: 0 for section in data}
+    errors = []
+
+    def flush(section):
+        imported[section] += len(data[section].extend(batches[section]))
+        batches[section] = []
+
+    for line_number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+        except ValueError:
+            item = None
+        if not isinstance(item, dict) or item.get("section") not in data:
+            err_message = "Line must be an object with a known section"
+        else:
+            _, err_message = VALIDATORS[item["section"]](item.get("record"))
+        if err_message:
+            if len(errors) < MAX_IMPORT_ERRORS:
+                errors.append({"line": line_number, "error": err_message})
+            continue
+        batches[item["section"]].append(build_record(item["section"], item["record"]))
+        if len(batches[item["section"]]) >= IMPORT_BATCH_SIZE:
+            flush(item["section"])
+
+    for section in data:
+        flush(section)
+    return jsonify({"imported": imported, "errors": errors})
+
+
+def validate_request(req, required_fields):
+    '''
+    Returns an error code and message if the request is invalid.
+    The handlers use the validators compiled in validation.py instead
+    '''
     if not isinstance(req, dict):
         return 400, "Request data is not valid JSON"
+
+    missing_fields = [field for field in required_fields if field not in req]
     if missing_fields:
         return 400, f"Missing fields: {', '.join(missing_fields)}"
 
     # Validate fields types
-    for field in list(required_fields.keys()):
-        if required_fields[field] == "string":
-            if not isinstance(req[field], str):
-                return 400, "Some fields have incorrect type"
-        if required_fields[field] == "int":
-            if not isinstance(req[field], int):
-                return 400, "Some fields have incorrect type"
+    for field, field_type in required_fields.items():
+        if field_type == "string" and not isinstance(req[field], str):
+            return 400, "Some fields have incorrect type"
+        if field_type == "int" and not isinstance(req[field], int):
+            return 400, "Some fields have incorrect type"
 
     return 0, ""
 
+@timed("lookup")
 def delete_education_by_index(data, index):
     '''
     Delete and return specific education by index or None if not found
     '''
-    index = int(index)
-    if 0 <= index < len(data["education"]):
-        edu = data["education"].pop(index)
-        return jsonify({"course": edu.course,
-                        "school": edu.school,
-                        "start_date": edu.start_date,
-                        "end_date": edu.end_date,
-                        "grade": edu.grade,
-                        "logo": edu.logo,
-                        })
+    edu = data["education"].delete(index)
+    if edu is not None:
+        return jsonify(edu)
     return jsonify({"Server Error": "Couldn't find needed education"})
 
+@timed("lookup")
 def update_education_by_index(data, index, updated):
     '''
     Edit and return specific education by index or None if not found
     '''
-    index = int(index)
-    if 0 <= index < len(data["education"]):
-        data["education"].pop(index)
-        data["education"].insert(index, updated)
-        return jsonify({"course": updated.course,
-                        "school": updated.school,
-                        "start_date": updated.start_date,
-                        "end_date": updated.end_date,
-                        "grade": updated.grade,
-                        "logo": updated.logo,
-                        })
+    # an identical record is not written again
+    if data["education"].update(
+            index, lambda existing: existing if existing == updated else updated):
+        return jsonify(updated)
     return jsonify({"Server Error": "Couldn't find needed education"})
 
+@timed("lookup")
 def update_experience_by_index(data, index, new_experience_json):
     '''
     Update an existing experience by index or do nothing if not found
     You can only pass the field you want to change instead of passing a new whole object
     '''
-    index = int(index)
-    if 0 <= index < len(data["experience"]):
-        # Get the fields of the Experience class dynamically instead of hardcoding
-        fields_to_update = [field.name for field in dataclasses.fields(Experience)]
-        print(fields_to_update)
-        # Iterate over each field to update
-        for field in fields_to_update:
-            # Check if the field exists in new_experience_json
-            if field in new_experience_json:
-                # Update the corresponding field in the existing experience
-                setattr(data["experience"][index], field, new_experience_json[field])
-        return jsonify(data["experience"][index])
+    # Only keep the fields of the Experience class that exist in new_experience_json
+    changes = {field: new_experience_json[field]
+               for field in EXPERIENCE_FIELDS if field in new_experience_json}
+    # Apply the changes under the section lock so concurrent partial
+    # updates of the same experience don't overwrite each other
+    updated = data["experience"].update(
+        index, lambda existing: apply_changes(existing, changes))
+    if updated is not None:
+        return jsonify(updated)
     return jsonify({"Server Error": "Couldn't find needed experience"})
 
+@timed("lookup")
 def update_skill_by_index(data, index, updated):
     '''
     Edit and return specific skill by index or None if not found
     '''
-    index = int(index)
-    if 0 <= index < len(data["skill"]):
-        data["skill"].pop(index)
-        data["skill"].insert(index, updated)
-        return jsonify({"name": updated.name,
-                        "proficiency": updated.proficiency,
-                        "logo": updated.logo,
-                        })
+    if data["skill"].update(
+            index, lambda existing: existing if existing == updated else updated):
+        return jsonify(updated)
     return jsonify({"Server Error": "Couldn't find needed skill"})
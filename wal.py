@@ -0,0 +1,311 @@
+'''
+Write-ahead log of the in-memory sections, so they survive a crash or a
+restart. Every write is appended to the log, periodic snapshots hold the
+whole resume, and on startup the last snapshot plus the log written after it
+are replayed.
+
+Durability is set with RESUME_WAL_FSYNC:
+- "always": a write returns once it is on disk. Writes that arrive while the
+  log is being synced wait for the next sync together (group commit)
+- "interval": the log is synced every RESUME_WAL_INTERVAL_MS milliseconds,
+  a crash loses at most that much
+- "off": the log is written but never synced, the OS decides when
+'''
+
+import json
+import os
+import threading
+import time
+from models import SECTION_MODELS
+from serialization import record_to_dict
+
+# Directory of the log and snapshots, the log is off unless it is set
+WAL_DIR = os.environ.get("RESUME_WAL_DIR")
+FSYNC_POLICY = os.environ.get("RESUME_WAL_FSYNC", "always")
+FSYNC_POLICIES = ("always", "interval", "off")
+FSYNC_INTERVAL = int(os.environ.get("RESUME_WAL_INTERVAL_MS", "100")) / 1000
+# Number of logged writes after which a new snapshot is taken
+SNAPSHOT_EVERY = int(os.environ.get("RESUME_WAL_SNAPSHOT_EVERY", "10000"))
+SNAPSHOT_FILE = "snapshot.json"
+
+
+def _encode(kind, value):
+    '''
+    Turn the value of a logged write into JSON data
+    '''
+    if kind in ("create", "update"):
+        return record_to_dict(value, public=False)
+    if kind == "extend":
+        return [record_to_dict(record, public=False) for record in value]
+    if kind == "apply":
+        return [[op, index, None if record is None else record_to_dict(record, public=False)]
+                for op, index, record in value]
+    return None
+
+
+def _replay(section, model, entry):
+    '''
+    Apply a logged write to a section
+    '''
+    kind, index, value = entry["op"], entry["index"], entry["value"]
+    if kind == "create":
+        section.append(model(**value))
+    elif kind == "extend":
+        section.extend([model(**record) for record in value])
+    elif kind == "update":
+        section.replace(index, model(**value))
+    elif kind == "delete":
+        section.delete(index)
+    elif kind == "apply":
+        operations = []
+        for op, op_index, record in value:
+            record = None if record is None else model(**record)
+            if op == "update":
+                operations.append((op, op_index, lambda _, record=record: record))
+            else:
+                operations.append((op, op_index, record))
+        section.apply(operations)
+
+
+def _fsync_directory(directory):
+    '''
+    Sync a directory so that files created or renamed in it survive a crash
+    '''
+    descriptor = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+class SectionJournal:
+    '''
+    What a section sees of the log: it appends its writes, tells where the
+    log is, and waits for its writes to be durable
+    '''
+
+    def __init__(self, wal, name):
+        self.wal = wal
+        self.name = name
+
+    def append(self, kind, index, value):
+        '''
+        Log a write of the section
+        '''
+        self.wal.append(self.name, kind, index, value)
+
+    def position(self):
+        '''
+        Return the sequence number of the last logged write
+        '''
+        return self.wal.seq
+
+    def wait(self):
+        '''
+        Wait until what was logged so far is durable
+        '''
+        self.wal.wait()
+
+
+class WriteAheadLog:  # pylint: disable=too-many-instance-attributes
+    '''
+    The log is a series of NDJSON segment files named after the sequence
+    number of their first write. Writers add encoded lines to a buffer, a
+    background thread writes the buffer out and syncs it. Taking a snapshot
+    starts a new segment, and the older ones are deleted once the snapshot
+    is on disk
+    '''
+
+    def __init__(self, directory, policy=FSYNC_POLICY, snapshot_every=SNAPSHOT_EVERY):
+        if policy not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy: {policy}")
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.policy = policy
+        self.snapshot_every = snapshot_every
+        self.sections = {}
+        # seq is the last logged write, durable the last one on disk
+        self.seq = 0
+        self.durable = 0
+        self._pending = []
+        self._file = None
+        self._cond = threading.Condition()
+        # held while writing to the segment file, so lines stay in order
+        self._io_lock = threading.Lock()
+        # held for a whole snapshot, so close waits for the one under way
+        self._snapshot_lock = threading.Lock()
+        self._snapshot_needed = threading.Event()
+
+    def _segments(self):
+        '''
+        Return the paths of the log segments, oldest first
+        '''
+        names = sorted(name for name in os.listdir(self.directory)
+                       if name.startswith("log-") and name.endswith(".ndjson"))
+        return [os.path.join(self.directory, name) for name in names]
+
+    def _open_segment(self):
+        path = os.path.join(self.directory, f"log-{self.seq + 1:020d}.ndjson")
+        # pylint: disable=consider-using-with
+        self._file = open(path, "ab")
+        _fsync_directory(self.directory)
+
+    def recover(self, data):
+        '''
+        Load the last snapshot and the log after it into the sections of data,
+        then log every later write of these sections. If there is no snapshot
+        yet, one is taken of the sections as they are
+        '''
+        path = os.path.join(self.directory, SNAPSHOT_FILE)
+        positions = {}
+        if os.path.exists(path):
+            with open(path, "rb") as snapshot:
+                for name, state in json.load(snapshot).items():
+                    model = SECTION_MODELS[name]
+                    data[name].restore(state["next"], [(key, model(**record))
+                                                       for key, record in state["items"]])
+                    positions[name] = state["seq"]
+        self.seq = max(positions.values(), default=0)
+        for segment in self._segments():
+            with open(segment, "rb") as log:
+                for line in log:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # the end of a line that was being written in a crash
+                        break
+                    self.seq = max(self.seq, entry["seq"])
+                    if entry["seq"] > positions.get(entry["section"], 0):
+                        _replay(data[entry["section"]], SECTION_MODELS[entry["section"]], entry)
+        self.durable = self.seq
+        self.sections = data
+        # never append to a segment that may end with half a line
+        self._open_segment()
+        for name, section in data.items():
+            section.journal = SectionJournal(self, name)
+        threading.Thread(target=self._flush_loop, daemon=True).start()
+        threading.Thread(target=self._snapshot_loop, daemon=True).start()
+        if not os.path.exists(path):
+            self.snapshot()
+        return data
+
+    def append(self, section, kind, index, value):
+        '''
+        Add a write to the log. Called with the lock of the section held
+        '''
+        with self._cond:
+            self.seq += 1
+            self._pending.append(json.dumps({
+                "seq": self.seq, "section": section, "op": kind,
+                "index": index, "value": _encode(kind, value),
+            }, separators=(",", ":")).encode() + b"\n")
+            self._cond.notify_all()
+            if self.seq % self.snapshot_every == 0:
+                self._snapshot_needed.set()
+
+    def wait(self):
+        '''
+        With the "always" policy, wait until every write logged so far is on
+        disk. Returns at once with the other policies
+        '''
+        if self.policy != "always":
+            return
+        with self._cond:
+            target = self.seq
+            while self.durable < target and self._file is not None:
+                self._cond.wait()
+
+    def _flush(self):
+        '''
+        Write out the buffered lines and sync them, according to the policy
+        '''
+        with self._io_lock:
+            with self._cond:
+                pending, self._pending = self._pending, []
+                last = self.seq
+            if self._file is None:
+                return
+            if pending:
+                self._file.write(b"".join(pending))
+                self._file.flush()
+                if self.policy != "off":
+                    os.fsync(self._file.fileno())
+        with self._cond:
+            self.durable = max(self.durable, last)
+            self._cond.notify_all()
+
+    def _flush_loop(self):
+        while self._file is not None:
+            if self.policy == "interval":
+                time.sleep(FSYNC_INTERVAL)
+            else:
+                with self._cond:
+                    while not self._pending and self._file is not None:
+                        self._cond.wait()
+            self._flush()
+
+    def _snapshot_loop(self):
+        while self._file is not None:
+            if self._snapshot_needed.wait(1):
+                self._snapshot_needed.clear()
+                self.snapshot()
+
+    def snapshot(self):
+        '''
+        Write a snapshot of every section and delete the log it makes
+        obsolete. Writers are only blocked while each section is copied
+        '''
+        with self._snapshot_lock:
+            with self._io_lock:
+                if self._file is None:
+                    return
+                # start a new segment, the older ones only hold writes the
+                # snapshot is going to include
+                with self._cond:
+                    pending, self._pending = self._pending, []
+                    last = self.seq
+                self._file.write(b"".join(pending))
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._file.close()
+                with self._cond:
+                    self._open_segment()
+                    # the flush thread finds nothing left to write, so the
+                    # writers waiting for these lines are woken up here
+                    self.durable = max(self.durable, last)
+                    self._cond.notify_all()
+                # with no write since the last snapshot the new segment has the
+                # name of the old one
+                old_segments = [segment for segment in self._segments()
+                                if segment != self._file.name]
+
+            state = {}
+            for name, section in self.sections.items():
+                position, next_key, items = section.snapshot()
+                state[name] = {"seq": position, "next": next_key,
+                               "items": [[key, record_to_dict(record, public=False)]
+                                         for key, record in items]}
+            path = os.path.join(self.directory, SNAPSHOT_FILE)
+            with open(f"{path}.tmp", "w", encoding="utf-8") as snapshot:
+                json.dump(state, snapshot, separators=(",", ":"))
+                snapshot.flush()
+                os.fsync(snapshot.fileno())
+            os.replace(f"{path}.tmp", path)
+            _fsync_directory(self.directory)
+            for segment in old_segments:
+                os.remove(segment)
+
+    def close(self):
+        '''
+        Write out and sync what is buffered, then stop logging
+        '''
+        self._flush()
+        with self._snapshot_lock, self._io_lock:
+            if self._file is not None:
+                os.fsync(self._file.fileno())
+                self._file.close()
+            with self._cond:
+                self._file = None
+                self._cond.notify_all()
+        for section in self.sections.values():
+            section.journal = None